@@ -155,22 +155,25 @@ function BboxWatcher({ onBboxChange }) {
 
 
 
-const fetchAllPages = async (signal, onBatch) => {
-  let offset = 0;
-  while (!signal.aborted) {
+// Recorre las páginas keyset de un endpoint de features (next_cursor) y
+// devuelve todas sus features, como mucho maxFeatures.
+const PAGE_DELAY = 16;
+const fetchAllPages = async (path, paramsBase, signal, maxFeatures = Infinity) => {
+  const all = [];
+  let cursor = ""; // keyset: "" = primera página, luego next_cursor
+  while (!signal.aborted && all.length < maxFeatures) {
     const params = new URLSearchParams(paramsBase);
-    params.set("offset", String(offset));
-    const res = await fetch(`${API_BASE}/irradiance/features?${params}`, { signal });
-    if (!res.ok) break;
+    params.set("cursor", cursor);
+    const res = await fetch(`${API_BASE}${path}?${params}`, { signal });
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
     const fc = await res.json();
-    const feats = fc?.features || [];
-    if (!feats.length) break;
-    onBatch(feats);
-    offset += feats.length;
-    if (feats.length < PAGE_LIMIT) break; // last page
+    for (const f of fc?.features || []) all.push(f);
+    if (!fc?.next_cursor) break; // last page
+    cursor = fc.next_cursor;
     // yield to main thread
-    await new Promise(r => setTimeout(r, CHUNK_DELAY));
+    await new Promise(r => setTimeout(r, PAGE_DELAY));
   }
+  return all.slice(0, maxFeatures);
 };
 
 
@@ -261,20 +264,16 @@ function IrradianceLayer({ bbox, minZoom = 17, maxZoom = 19 }) {
     const ac = new AbortController();
     abortRef.current = ac;
 
-    const params = new URLSearchParams({ bbox: padded.join(","), limit: "100000", offset: "0" });
-    const url = `${API_BASE}/irradiance/features?${params}`;
+    const paramsBase = { bbox: padded.join(","), limit: "20000" };
 
     // start fade (very small fade so it never “sticks invisible”)
     setPaneOpacity(0.2);
 
     (async () => {
       try {
-        const res = await fetch(url, { signal: ac.signal });
-        if (!res.ok) throw new Error(`HTTP ${res.status}`);
-        const fc = await res.json();
+        const features = await fetchAllPages("/irradiance/features", paramsBase, ac.signal, 100000);
         if (ac.signal.aborted) return;
 
-        const features = fc?.features || [];
         if (!features.length) {
           // nothing new → keep the current layer, just restore opacity
           prevFetchBBoxRef.current = padded;
@@ -310,7 +309,7 @@ function IrradianceLayer({ bbox, minZoom = 17, maxZoom = 19 }) {
         nextRef.current = lyr;
 
         // add progressively
-        progressivelyAdd(fc, lyr, ac.signal);
+        progressivelyAdd({ features }, lyr, ac.signal);
         // swap when done (queue a microtask so the last chunk paints)
         setTimeout(() => {
           if (ac.signal.aborted) return;
@@ -449,17 +448,14 @@ function BuildingIrradianceLayer({ bbox, onLegendChange,onBuildingClick  }) {
     const ac = new AbortController();
     abortRef.current = ac;
 
-    const params = new URLSearchParams({ bbox: bbox.join(","), limit: "50000", offset: "0" });
-    const url = `${API_BASE}/buildings/irradiance?${params}`;
+    const paramsBase = { bbox: bbox.join(","), limit: "10000" };
 
     (async () => {
       try {
-        const res = await fetch(url, { signal: ac.signal });
-        if (!res.ok) throw new Error(`HTTP ${res.status}`);
-        const fc = await res.json();
+        const all = await fetchAllPages("/buildings/irradiance", paramsBase, ac.signal, 50000);
         if (ac.signal.aborted) return;
 
-        const feats = (fc?.features||[]).filter(f => f?.geometry);
+        const feats = all.filter(f => f?.geometry);
         // compute bins from visible buildings
         const values = feats.map(f => f.properties?.irr_building).filter(v => typeof v === "number" && isFinite(v));
         const min = Math.min(...values);
@@ -728,14 +724,11 @@ function CelsBufferLayer({ radiusMeters = 2000 }) {
     abortRef.current = ac;
 
     const cityBBox = [-3.766250610351563, 40.279394708323274, -3.685398101806641, 40.32560453181949];
-    const params = new URLSearchParams({ bbox: cityBBox.join(","), limit: "20000", offset: "0" });
-    const url = `${API_BASE}/cels/features?${params}`;
+    const paramsBase = { bbox: cityBBox.join(","), limit: "5000" };
 
     (async () => {
       try {
-        const res = await fetch(url, { signal: ac.signal });
-        if (!res.ok) throw new Error(`HTTP ${res.status}`);
-        const data = await res.json();
+        const data = { features: await fetchAllPages("/cels/features", paramsBase, ac.signal, 20000) };
         if (ac.signal.aborted) return;
 
         const group = L.layerGroup([], { pane: paneName });
@@ -0,0 +1,195 @@
+# addresses.py — in-memory address index for /address/lookup and /address/suggest
+#
+# address_index (decenas de miles de filas) se carga entera al arrancar:
+# calles únicas en un array ordenado (prefijos con bisect, también desde cada
+# palabra: "LA CIERV" -> "JUAN DE LA CIERVA"), trigramas por calle para las erratas y,
+# por calle, sus números en orden natural con la referencia. Como en
+# proximity.CelsIndex, se reconstruye entero y se sustituye de golpe; la firma
+# de la tabla (filas + XOR de hashes) dice cuándo hace falta.
+from __future__ import annotations
+import bisect, re, unicodedata
+from collections import defaultdict
+from typing import NamedTuple
+
+import duckdb
+
+STREET_PREFIXES = ("CALLE ", "CL ", "C/ ", "AVENIDA ", "AV ", "AV.", "PASEO ", "PS ", "PLAZA ", "PZA ")
+
+# "JUAN DE LA CIERVA 12", "madrid, 3b" -> (calle, número)
+_TRAILING_NUMBER = re.compile(r"^(.*?)[\s,]+(\d+\S*)$")
+_NUMBER_KEY = re.compile(r"^(\d+)(.*)$")
+
+
+def normalize(s: str | None) -> str:
+    """Upper-case, accent-free, without street-type prefix, single spaces."""
+    s = "" if s is None else s
+    if not s.isascii():
+        s = unicodedata.normalize("NFD", s)
+        s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
+    s = s.upper().strip()
+    for p in STREET_PREFIXES:
+        if s.startswith(p):
+            s = s[len(p):]
+    return " ".join(s.split())
+
+
+def split_number(text: str) -> tuple[str, str | None]:
+    """Normalized "STREET 12" -> ("STREET", "12"); ("STREET", None) without a trailing number."""
+    m = _TRAILING_NUMBER.match(text)
+    return (m.group(1), m.group(2)) if m else (text, None)
+
+
+def _number_key(n: str) -> tuple[int, str]:
+    m = _NUMBER_KEY.match(n)
+    return (int(m.group(1)), m.group(2)) if m else (1 << 30, n)
+
+
+def _trigrams(s: str) -> set[str]:
+    s = f"  {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def edit_distance(a: str, b: str, max_d: int) -> int:
+    """Levenshtein distance, or max_d + 1 as soon as it is known to exceed max_d."""
+    big = max_d + 1
+    if abs(len(a) - len(b)) > max_d:
+        return big
+    # solo la banda |i - j| <= max_d de la matriz: fuera de ella ya se pasa
+    prev = [j if j <= max_d else big for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, 1):
+        lo, hi = max(1, i - max_d), min(len(b), i + max_d)
+        cur = [big] * (len(b) + 1)
+        if i <= max_d:
+            cur[0] = i
+        for j in range(lo, hi + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != b[j - 1]))
+        if min(cur[lo - 1:hi + 1]) > max_d:
+            return big
+        prev = cur
+    return min(prev[-1], big)
+
+
+class Suggestion(NamedTuple):
+    street: str
+    number: str | None
+    reference: str | None
+    match: str          # exact | prefix | word | fuzzy
+    distance: int       # ediciones (solo fuzzy; 0 en el resto)
+
+
+# orden de los tipos de coincidencia en el ranking
+_TIERS = {"exact": 0, "prefix": 1, "word": 2, "fuzzy": 3}
+FUZZY_CANDIDATES = 30  # calles que pasan a la distancia de edición
+
+
+class AddressIndex:
+    def __init__(self):
+        self.loaded = False
+        self.signature: tuple | None = None
+        self._streets: list[str] = []
+        self._tails: list[tuple[str, int]] = []        # (calle desde su 2ª, 3ª… palabra, id), ordenado
+        self._grams: dict[str, list[int]] = {}
+        self._numbers: list[list[tuple[str, str]]] = []  # por calle: [(número, referencia)]
+        self._exact: dict[tuple[str, str], str] = {}
+
+    @property
+    def size(self) -> int:
+        return len(self._exact)
+
+    @staticmethod
+    def table_signature(con: duckdb.DuckDBPyConnection) -> tuple:
+        return con.execute("""
+            SELECT COUNT(*), bit_xor(hash(street_norm, number_norm, reference)) FROM address_index;
+        """).fetchone()
+
+    def refresh(self, con: duckdb.DuckDBPyConnection) -> bool:
+        """Rebuilds the index if address_index changed; True when it was rebuilt."""
+        sig = self.table_signature(con)
+        if self.loaded and sig == self.signature:
+            return False
+        rows = con.execute("""
+            SELECT street_norm, CAST(number_norm AS VARCHAR), reference
+            FROM address_index
+            WHERE street_norm IS NOT NULL AND number_norm IS NOT NULL
+            ORDER BY street_norm, number_norm, reference;
+        """).fetchall()
+        exact: dict[tuple[str, str], str] = {}
+        by_street: dict[str, list[tuple[str, str]]] = defaultdict(list)
+        # street_norm / number_norm ya vienen normalizados: se usan tal cual, igual
+        # que el WHERE street_norm = ? AND number_norm = ? sin índice cargado
+        for street, number, ref in rows:
+            if (street, number) not in exact:  # como el LIMIT 1 de la consulta original
+                exact[(street, number)] = ref
+                by_street[street].append((number, ref))
+        streets = sorted(by_street)
+        tails, grams = [], defaultdict(list)
+        for sid, street in enumerate(streets):
+            parts = street.split()
+            tails += [(" ".join(parts[k:]), sid) for k in range(1, len(parts))]
+            for g in _trigrams(street):
+                grams[g].append(sid)
+        tails.sort()
+        numbers = [sorted(by_street[s], key=lambda t: _number_key(t[0])) for s in streets]
+        # sustitución atómica: las peticiones en curso siguen con el índice anterior
+        (self._streets, self._tails, self._grams, self._numbers, self._exact,
+         self.signature, self.loaded) = (streets, tails, dict(grams), numbers, exact, sig, True)
+        return True
+
+    def lookup(self, street_norm: str, number_norm: str) -> str | None:
+        return self._exact.get((street_norm, number_norm))
+
+    # ---- autocompletado ----
+
+    def match_streets(self, street_q: str, limit: int, max_edits: int | None = None) -> list[tuple[int, str, int]]:
+        """Ranked (street id, match kind, distance) for a normalized partial street."""
+        if not street_q:
+            return []
+        streets, tails = self._streets, self._tails
+        found: dict[int, tuple[str, int]] = {}
+        i = bisect.bisect_left(streets, street_q)
+        while i < len(streets) and streets[i].startswith(street_q):
+            found[i] = ("exact" if streets[i] == street_q else "prefix", 0)
+            i += 1
+        i = bisect.bisect_left(tails, (street_q,))
+        while i < len(tails) and tails[i][0].startswith(street_q):
+            found.setdefault(tails[i][1], ("word", 0))
+            i += 1
+        # erratas: solo si nada coincide literalmente
+        if not found and len(street_q) >= 3:
+            max_d = max(1, len(street_q) // 4) if max_edits is None else max_edits
+            grams = _trigrams(street_q)
+            overlap: dict[int, int] = defaultdict(int)
+            for g in grams:
+                for sid in self._grams.get(g, ()):
+                    overlap[sid] += 1
+            # cada edición estropea como mucho 3 trigramas: el resto no puede estar a <= max_d
+            min_common = len(grams) - 3 * max_d
+            cands = sorted((sid for sid, n in overlap.items() if n >= min_common and sid not in found),
+                           key=overlap.get, reverse=True)[:FUZZY_CANDIDATES]
+            n = len(street_q)
+            for sid in cands:
+                s = streets[sid]
+                # contra el comienzo de la calle si es más larga: el usuario aún está escribiendo
+                d = edit_distance(street_q, s if len(s) <= n + max_d else s[:n], max_d)
+                if d <= max_d:
+                    found[sid] = ("fuzzy", d)
+        ranked = sorted(found.items(),
+                        key=lambda kv: (_TIERS[kv[1][0]], kv[1][1], len(streets[kv[0]]), streets[kv[0]]))
+        return [(sid, kind, d) for sid, (kind, d) in ranked[:limit]]
+
+    def suggest(self, text: str, limit: int = 10) -> list[Suggestion]:
+        """Street (+ number when the input ends in one) candidates, best first."""
+        street_q, number_q = split_number(normalize(text))
+        out: list[Suggestion] = []
+        for sid, kind, d in self.match_streets(street_q, limit):
+            street = self._streets[sid]
+            if number_q is None:
+                out.append(Suggestion(street, None, None, kind, d))
+            else:
+                nums = self._numbers[sid]
+                hits = [t for t in nums if t[0] == number_q] + \
+                       [t for t in nums if t[0] != number_q and t[0].startswith(number_q)]
+                out.extend(Suggestion(street, n, ref, kind, d) for n, ref in hits[:limit - len(out)])
+            if len(out) >= limit:
+                break
+        return out
@@ -1,16 +1,26 @@
 # app.py — single FastAPI app, per-request DuckDB connections
 from __future__ import annotations
-import os, json, duckdb, unicodedata
+import os, io, csv, json, math, base64, hmac, duckdb
 from typing import List, Tuple
 
-from fastapi import FastAPI, HTTPException, Query, Depends
+from fastapi import FastAPI, HTTPException, Query, Depends, Response, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from contextlib import contextmanager
 
+import migrations, proximity, addresses, compression, cache, metrics, profiler
+import time
 
-import threading
+
+import queue, threading, tempfile
+import anyio
+
+try:  # opcional: solo lo necesita format=arrow
+    import pyarrow as pa
+except ImportError:
+    pa = None
 # ============================================================
 # SETTINGS
 # ============================================================
@@ -26,9 +36,72 @@ def _resolve_db_path() -> str:
 
 DB_PATH = _resolve_db_path()
 READ_ONLY = os.getenv("READ_ONLY", "true").lower() == "true"
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "false").lower() == "true"  # migrar: python migrations.py
+# Clases de consulta: "heavy" (scans / exportaciones) y "light" (lecturas puntuales),
+# cada una con su concurrencia y su cola máxima de espera
+HEAVY_CONCURRENCY = int(os.getenv("DUCKDB_HEAVY_CONCURRENCY", "2"))
+HEAVY_QUEUE = int(os.getenv("DUCKDB_HEAVY_QUEUE", "8"))
+LIGHT_CONCURRENCY = int(os.getenv("DUCKDB_LIGHT_CONCURRENCY", str(max(2, os.cpu_count() or 4))))
+LIGHT_QUEUE = int(os.getenv("DUCKDB_LIGHT_QUEUE", "64"))
+RETRY_AFTER_S = int(os.getenv("RETRY_AFTER_S", "2"))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "1000"))  # 0 = profiler desactivado
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+POOL_SIZE = int(os.getenv("DUCKDB_POOL_SIZE", str(HEAVY_CONCURRENCY + LIGHT_CONCURRENCY)))
+POOL_TIMEOUT_S = float(os.getenv("DUCKDB_POOL_TIMEOUT_S", "10"))
+STREAM_BATCH_ROWS = int(os.getenv("STREAM_BATCH_ROWS", "5000"))
+ZONAL_BATCH_MAX = int(os.getenv("ZONAL_BATCH_MAX", "5000"))
+ZONAL_EDGE_SCANS = int(os.getenv("ZONAL_EDGE_SCANS", "64"))  # escaneos por R-tree para los bordes de una zona
+GEOCODE_BATCH_MAX = int(os.getenv("GEOCODE_BATCH_MAX", "50000"))
+BUILDINGS_BATCH_MAX = int(os.getenv("BUILDINGS_BATCH_MAX", "5000"))
+AGG_MAX_BINS = int(os.getenv("AGG_MAX_BINS", "20000"))
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+RESPONSE_CACHE_MB = int(os.getenv("RESPONSE_CACHE_MB", "256"))
 
 app = FastAPI(title=f"EMSV API ({'RO' if READ_ONLY else 'RW'})")
 
+# gzip / br / zstd negociado
+app.add_middleware(compression.CompressionMiddleware, minimum_size=COMPRESS_MIN_BYTES)
+
+# Versión por tabla de los datos servidos: la suben las escrituras (puntos,
+# CELS) y forma parte de la clave y del ETag de las respuestas cacheadas
+DATA_VERSIONS = cache.DataVersions()
+
+def bump_data_version(*tables: str) -> None:
+    DATA_VERSIONS.bump(*tables)
+
+CELS_TABLES = ("autoconsumos_CELS", "cels_points")
+
+# Tablas de las que depende cada ruta GET; las no listadas dependen de todas
+CACHE_ROUTE_TABLES = {
+    "/cels": CELS_TABLES,
+    "/debug/cels": CELS_TABLES,
+    "/points": ("points", "big_points"),
+    "/buffers": ("points", "point_buffers"),
+    "/irradiance": ("irr_points",),
+    "/shadows": ("shadows", "puntos_no_parcelas"),
+    "/parcels": ("parcels", "edificios_metrics"),
+    "/buildings": ("buildings", "edificios_metrics"),
+    "/address": ("buildings", "address_index"),
+    "/cadastre": ("buildings",),
+    "/tiles": ("buildings", "edificios_metrics", "parcels", "irr_points",
+               "shadows", "puntos_no_parcelas"),
+}
+
+# Caché LRU de respuestas GET (ya comprimidas) + ETag / 304; va por fuera de la compresión
+RESPONSE_CACHE = cache.BytesLRU(RESPONSE_CACHE_MB * 1024 * 1024)
+app.add_middleware(
+    cache.ResponseCacheMiddleware,
+    versions=DATA_VERSIONS,
+    route_tables=CACHE_ROUTE_TABLES,
+    store=RESPONSE_CACHE,
+    skip=("/api/visor_emsv", "/docs", "/openapi.json", "/metrics", "/admin"),
+)
+
+# Latencias, filas y bytes por ruta (GET /metrics); mide también los aciertos de caché
+app.add_middleware(metrics.MetricsMiddleware, router_app=app)
+
+# CORS el más externo: las cabeceras se ponen en cada respuesta según su Origin,
+# también en las servidas desde la caché o compartidas por single-flight
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -47,7 +120,7 @@ def _shadow_table_or_400(name: str) -> str:
 
 
 # ============================================================
-# DATABASE CONNECTION HANDLING (per request)
+# DATABASE CONNECTION HANDLING (read pool + shared writer)
 # ============================================================
 @contextmanager
 def get_db_connection(read_only: bool = True):
@@ -80,52 +153,252 @@ def get_db_connection(read_only: bool = True):
             except:
                 pass
 
-def _open_conn(read_only: bool):
-    # 👇 OJO: NO uses read_only=... en connect (Windows bloquea a veces)
-    con = duckdb.connect(DB_PATH)  # <- sin read_only
-    con.execute("LOAD spatial;")
+# Conexión compartida de escritura; las lecturas usan cursores del pool
+# (👇 OJO: NO uses read_only=... en connect, Windows bloquea a veces)
+DB_RW = duckdb.connect(DB_PATH)
+DB_RW.execute("LOAD spatial;")
+try:
+    threads = max(1, (os.cpu_count() or 4) - 1)
+    DB_RW.execute(f"PRAGMA threads={threads};")
+    DB_RW.execute("SET lock_timeout='5s';")
+except duckdb.Error:
+    pass
+
+# Columnas derivadas (ref_upper, ref14…) e índices; ver migrations.py.
+# Las migraciones reescriben tablas grandes: por defecto se lanzan a mano
+# (python migrations.py) y nunca en modo READ_ONLY
+if AUTO_MIGRATE and READ_ONLY:
+    print("AUTO_MIGRATE ignorado: la API está en modo READ_ONLY")
+elif AUTO_MIGRATE:
     try:
-        threads = max(1, (os.cpu_count() or 4) - 1)
-        con.execute(f"PRAGMA threads={threads};")
-        con.execute("SET lock_timeout='5s';")
-        # Si quieres forzar lectura:
-        if read_only:
-            con.execute("SET access_mode='read_only';")  # <- solo lectura a nivel SQL
-            con.execute("BEGIN READ ONLY;")              # <- opcional, asegura R/O
-    except duckdb.Error:
-        pass
-    return con
+        migrations.apply_migrations(DB_RW)
+        # por si buildings se ha recargado sin tocar schema_migrations
+        migrations.refresh_cels_points(DB_RW)
+    except Exception as e:
+        print("Migraciones no aplicadas:", e)
+
+# Tablas con columnas minx/miny/maxx/maxy y sin R-tree utilizable: en ellas
+# parse_bbox antepone un filtro numérico que DuckDB resuelve con zone maps.
+# (con R-tree no se añade: el escaneo por índice no admite filtros de tabla)
+BBOX_PREFILTER_TABLES: set[str] = set()
+# Todas las tablas con esas columnas: el modo keyset de paginate() las usa
+# siempre (ver su docstring)
+BBOX_COLUMN_TABLES = {
+    t for t in migrations.SPATIAL_TABLES
+    if all(migrations.column_exists(DB_RW, t, c) for c in migrations.BBOX_COLUMNS)
+}
+
+# Tablas con ref_upper / ref14 (migrations.py). En un warehouse sin migrar
+# se calculan al vuelo desde reference: funciona, pero sin índice
+REF_UPPER_TABLES = {t for t in ("buildings", "edificios_metrics", "autoconsumos_CELS")
+                    if migrations.column_exists(DB_RW, t, "ref_upper")}
+REF14_TABLES = {t for t in ("buildings", "autoconsumos_CELS")
+                if migrations.column_exists(DB_RW, t, "ref14")}
+if len(REF_UPPER_TABLES) < 3 or len(REF14_TABLES) < 2:
+    print("Columnas ref_upper/ref14 ausentes: búsquedas por referencia sin índice -> python migrations.py")
+
+def ref_upper_sql(table: str, alias: str = "") -> str:
+    """UPPER(reference) of `table`: the ref_upper column when migrated."""
+    p = f"{alias}." if alias else ""
+    return f"{p}ref_upper" if table in REF_UPPER_TABLES else f"UPPER({p}reference)"
+
+def ref14_sql(table: str, alias: str = "") -> str:
+    """First 14 characters of UPPER(reference): the ref14 column when migrated."""
+    p = f"{alias}." if alias else ""
+    return f"{p}ref14" if table in REF14_TABLES else f"LEFT(UPPER({p}reference), 14)"
+
+# Tablas con columnas geom_lod* (ver migrations.LOD_TABLES)
+LOD_TABLES = {
+    t for t in migrations.LOD_TABLES
+    if all(migrations.column_exists(DB_RW, t, migrations.lod_column(i))
+           for i in range(1, len(migrations.LOD_TOLERANCES) + 1))
+}
+
+# Pirámides para /shadows/zonal e /irradiance/zonal (solo se usan si están al día)
+try:
+    ZONAL_GRID_TABLES = migrations.refresh_zonal_grids(DB_RW, rebuild=AUTO_MIGRATE and not READ_ONLY)
+except duckdb.Error as e:
+    ZONAL_GRID_TABLES = set()
+    print("Pirámides zonales no disponibles:", e)
+
+# cels_points (migración 002_cels_points): punto de cada CELS para /cels/features
+# y el KD-tree. Si el warehouse no está migrado se calcula al arrancar en una
+# base en memoria (ATTACH: la ven todos los cursores) y las escrituras la
+# mantienen igual; al reiniciar se vuelve a calcular
+CELS_POINTS = "cels_points"
+
+def refresh_cels_points(con: duckdb.DuckDBPyConnection, cid: int | None = None,
+                        in_transaction: bool = False) -> None:
+    """
+    Recomputes CELS_POINTS for one CELS (or all). The warehouse table is
+    refreshed inside the write transaction (in_transaction=True); the
+    in-memory copy only after COMMIT, since a DuckDB transaction cannot write
+    two attached databases.
+    """
+    if in_transaction != (CELS_POINTS == "cels_points"):
+        return
+    migrations.refresh_cels_points(con, cid, CELS_POINTS,
+                                   ref14_sql("autoconsumos_CELS", "c"), ref14_sql("buildings", "b"))
 
-def get_conn():
-    # SOLO LECTURA (seguro para GETs concurrentes)
-    con = _open_conn(read_only=True)
+if not migrations.table_exists(DB_RW, "cels_points"):
     try:
-        yield con
-    finally:
-        con.close()
+        DB_RW.execute("ATTACH ':memory:' AS cels_mem;")
+        CELS_POINTS = "cels_mem.cels_points"
+        DB_RW.execute(f"CREATE TABLE {CELS_POINTS} (id INTEGER, geom GEOMETRY, geom_25830 GEOMETRY);")
+        refresh_cels_points(DB_RW)
+        print("cels_points ausente: calculado en memoria al arrancar -> python migrations.py")
+    except duckdb.Error as e:
+        print("No se pudo calcular cels_points:", e)
 
-# Conexiones compartidas (una RW y una RO)
-DB_RW = duckdb.connect(DB_PATH)                 # lectura/escritura
-DB_RO = duckdb.connect(DB_PATH) # solo lectura
+# Índice de proximidad de CELS (KD-tree en EPSG:25830), se rehace tras cada escritura
+CELS_INDEX = proximity.CelsIndex()
 
-for con in (DB_RW, DB_RO):
-    con.execute("LOAD spatial;")
+def refresh_cels_index(con: duckdb.DuckDBPyConnection) -> None:
     try:
-        threads = max(1, (os.cpu_count() or 4) - 1)
-        con.execute(f"PRAGMA threads={threads};")
-        con.execute("SET lock_timeout='5s';")
-    except duckdb.Error:
-        pass
+        CELS_INDEX.refresh(con, CELS_POINTS)
+    except duckdb.Error as e:
+        print("No se pudo cargar el índice de CELS:", e)
 
-# Si quieres serializar escrituras:
-RW_LOCK = threading.RLock()
+refresh_cels_index(DB_RW)
 
-def get_conn_ro():
-    # Con RO no hace falta lock: sólo lecturas
+# Índice de direcciones en memoria (/address/lookup, /address/suggest). Se carga
+# al arrancar: la API no escribe address_index y, con la base abierta por este
+# proceso, nadie más puede hacerlo; tras regenerarla basta con reiniciar
+ADDRESS_INDEX = addresses.AddressIndex()
+
+def refresh_address_index(con: duckdb.DuckDBPyConnection) -> None:
     try:
-        yield DB_RO
-    finally:
-        pass  # no cerrar
+        if ADDRESS_INDEX.refresh(con):
+            bump_data_version("address_index")
+    except duckdb.Error as e:
+        print("No se pudo cargar el índice de direcciones:", e)
+
+refresh_address_index(DB_RW)
+
+class ReadPool:
+    """
+    Bounded pool of pre-initialised read cursors over the shared database.
+
+    Each request thread checks out its own cursor (DuckDB connections are not
+    safe to share between threads), so there is no connect / LOAD spatial per
+    request. Cursors are health-checked on checkout and replaced if broken.
+    """
+
+    def __init__(self, parent: duckdb.DuckDBPyConnection, size: int):
+        self._parent = parent
+        self.size = size
+        self._idle: queue.LifoQueue = queue.LifoQueue(maxsize=size)
+        for _ in range(size):
+            self._idle.put(self._new_cursor())
+
+    @property
+    def idle(self) -> int:
+        return self._idle.qsize()
+
+    def _new_cursor(self) -> duckdb.DuckDBPyConnection:
+        cur = self._parent.cursor()
+        cur.execute("LOAD spatial;")
+        return cur
+
+    @staticmethod
+    def _healthy(cur: duckdb.DuckDBPyConnection) -> bool:
+        try:
+            cur.execute("SELECT 1").fetchone()
+            return True
+        except duckdb.Error:
+            return False
+
+    @contextmanager
+    def checkout(self, timeout: float = POOL_TIMEOUT_S):
+        try:
+            cur = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise HTTPException(503, "Base de datos ocupada, inténtalo de nuevo",
+                                headers={"Retry-After": str(RETRY_AFTER_S)})
+        try:
+            if not self._healthy(cur):
+                try:
+                    cur.close()
+                except duckdb.Error:
+                    pass
+                cur = self._new_cursor()
+            yield cur
+        finally:
+            self._idle.put(cur)
+
+READ_POOL = ReadPool(DB_RW, POOL_SIZE)
+
+class QueryLane:
+    """
+    Admission control for one class of queries: at most `concurrency` run at
+    once and at most `max_queue` wait for a slot; beyond that (or after
+    `timeout` seconds waiting) the request gets 503 + Retry-After instead of
+    piling up threads. Heavy scans therefore cannot starve point lookups.
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queue: int, timeout: float = POOL_TIMEOUT_S):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.waiting = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+
+    def _busy(self):
+        self.rejected += 1
+        return HTTPException(503, "Servidor ocupado, inténtalo de nuevo",
+                             headers={"Retry-After": str(RETRY_AFTER_S)})
+
+    @contextmanager
+    def slot(self):
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                raise self._busy()
+            self.waiting += 1
+        try:
+            acquired = self._slots.acquire(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        if not acquired:
+            raise self._busy()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+HEAVY_LANE = QueryLane("heavy", HEAVY_CONCURRENCY, HEAVY_QUEUE)
+LIGHT_LANE = QueryLane("light", LIGHT_CONCURRENCY, LIGHT_QUEUE)
+
+@app.on_event("startup")
+async def _size_threadpool():
+    # los endpoints sync esperan su turno dentro del threadpool de Starlette:
+    # hay que dar hilos para todas las plazas de las dos colas
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens,
+                               HEAVY_CONCURRENCY + HEAVY_QUEUE + LIGHT_CONCURRENCY + LIGHT_QUEUE + 8)
+
+@contextmanager
+def _lane_conn(lane: QueryLane):
+    t0 = time.perf_counter()
+    with lane.slot(), READ_POOL.checkout() as con:
+        metrics.record_pool_wait(time.perf_counter() - t0)
+        yield con
+
+def get_conn():
+    # SOLO LECTURA: un cursor del pool por petición (consultas ligeras)
+    with _lane_conn(LIGHT_LANE) as con:
+        yield con
+
+def get_conn_heavy():
+    # SOLO LECTURA: scans grandes, exportaciones y agregados espaciales
+    with _lane_conn(HEAVY_LANE) as con:
+        yield con
+
+# Si quieres serializar escrituras:
+RW_LOCK = threading.RLock()
 
 def get_conn_rw():
     # Serializamos las operaciones de escritura
@@ -138,49 +411,503 @@ def get_conn_rw():
 
 
 
+def _profile_cursor() -> duckdb.DuckDBPyConnection:
+    cur = DB_RW.cursor()
+    cur.execute("LOAD spatial;")
+    return cur
+
+# Consultas por encima de SLOW_QUERY_MS: se re-ejecutan con EXPLAIN ANALYZE en segundo plano
+SLOW_QUERIES = profiler.SlowQueryProfiler(_profile_cursor, SLOW_QUERY_MS)
+
 def q(con: duckdb.DuckDBPyConnection, sql: str, params: list | tuple = ()):
     """Query helper that returns [] on empty and wraps errors."""
+    t0 = time.perf_counter()
+    try:
+        rows = con.execute(sql, params).fetchall() or []
+    except duckdb.Error as e:
+        raise HTTPException(500, f"DuckDB error: {e}") from e
+    finally:
+        metrics.record_query(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - t0
+    metrics.record_query(0.0, len(rows))
+    SLOW_QUERIES.observe(sql, params, elapsed, len(rows), metrics.current_route())
+    return rows
+
+def q_batches(con: duckdb.DuckDBPyConnection, sql: str, params: list | tuple = (),
+              batch_rows: int = STREAM_BATCH_ROWS):
+    """
+    Like q() but yields the rows in batches of `batch_rows` (fetchmany).
+    Runs on its own cursor so a shared connection is not blocked while streaming.
+    """
+    cur = con.cursor()
+    t0 = time.perf_counter()
+    try:
+        cur.execute(sql, params)
+    except duckdb.Error as e:
+        cur.close()
+        raise HTTPException(500, f"DuckDB error: {e}") from e
+    finally:
+        metrics.record_query(time.perf_counter() - t0)
+    # en streaming se mide hasta el primer lote (ejecución del plan)
+    SLOW_QUERIES.observe(sql, params, time.perf_counter() - t0, None, metrics.current_route())
+
+    def batches():
+        try:
+            while True:
+                t0 = time.perf_counter()
+                rows = cur.fetchmany(batch_rows)
+                metrics.record_query(time.perf_counter() - t0, len(rows))
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cur.close()
+
+    return batches()
+
+def q_arrow(con: duckdb.DuckDBPyConnection, sql: str, params: list | tuple = (),
+            batch_rows: int = STREAM_BATCH_ROWS):
+    """Like q_batches() but yields Arrow record batches; returns (schema, batches)."""
+    cur = con.cursor()
+    t0 = time.perf_counter()
     try:
-        return con.execute(sql, params).fetchall() or []
+        reader = cur.execute(sql, params).fetch_record_batch(batch_rows)
     except duckdb.Error as e:
+        cur.close()
         raise HTTPException(500, f"DuckDB error: {e}") from e
+    finally:
+        metrics.record_query(time.perf_counter() - t0)
+
+    def batches():
+        try:
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    batch = reader.read_next_batch()
+                except StopIteration:
+                    return
+                finally:
+                    metrics.record_query(time.perf_counter() - t0)
+                metrics.record_query(0.0, batch.num_rows)
+                yield batch
+        finally:
+            cur.close()
+
+    return reader.schema, batches()
 
 # ============================================================
 # HELPERS
 # ============================================================
 
-def parse_bbox(bbox: str | None) -> tuple[str, list]:
-    if not bbox:
-        return "", []
+def bbox_values(bbox: str) -> tuple[float, float, float, float]:
     parts = bbox.split(",")
     if len(parts) != 4:
         raise HTTPException(400, "bbox debe ser 'minx,miny,maxx,maxy'")
-    minx, miny, maxx, maxy = map(float, parts)
-    return "WHERE ST_Intersects(geom, ST_MakeEnvelope(?, ?, ?, ?))", [minx, miny, maxx, maxy]
+    try:
+        minx, miny, maxx, maxy = map(float, parts)
+    except ValueError:
+        raise HTTPException(400, "bbox debe ser 'minx,miny,maxx,maxy'")
+    if not all(map(math.isfinite, (minx, miny, maxx, maxy))):
+        raise HTTPException(400, "bbox con valores no finitos")
+    return minx, miny, maxx, maxy
 
-def parse_bbox_for_srid(bbox: str | None, target_srid: int) -> tuple[str, list]:
+def parse_bbox(bbox: str | None, table: str | None = None, prefilter: bool = False) -> tuple[str, list]:
     if not bbox:
         return "", []
-    parts = bbox.split(",")
-    if len(parts) != 4:
-        raise HTTPException(400, "bbox debe ser 'minx,miny,maxx,maxy'")
-    minx, miny, maxx, maxy = map(float, parts)
-    where = (
-        "WHERE ST_Intersects("
-        "  geom,"
-        "  ST_Transform("
-        "    ST_MakeEnvelope(?, ?, ?, ?),"
-        "    'EPSG:4326',"
-        f"    'EPSG:{target_srid}',"
-        "    TRUE"
-        "  )"
-        ")"
-    )
-    return where, [minx, miny, maxx, maxy]
+    minx, miny, maxx, maxy = bbox_values(bbox)
+    where = "WHERE ST_Intersects(geom, ST_MakeEnvelope(?, ?, ?, ?))"
+    params = [minx, miny, maxx, maxy]
+    if table in BBOX_PREFILTER_TABLES or (prefilter and table in BBOX_COLUMN_TABLES):
+        where = "WHERE minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ? AND " + where[len("WHERE "):]
+        params = [maxx, minx, maxy, miny] + params
+    return where, params
+
+def parse_bbox_for_srid(bbox: str | None, target_srid: int, table: str | None = None,
+                        prefilter: bool = False) -> tuple[str, list]:
+    if not bbox:
+        return "", []
+    minx, miny, maxx, maxy = bbox_values(bbox)
+    env = f"ST_Transform(ST_MakeEnvelope(?, ?, ?, ?), 'EPSG:4326', 'EPSG:{target_srid}', TRUE)"
+    where = f"WHERE ST_Intersects(geom, {env})"
+    params = [minx, miny, maxx, maxy]
+    if table in BBOX_PREFILTER_TABLES or (prefilter and table in BBOX_COLUMN_TABLES):
+        # el sobre transformado es constante: DuckDB lo pliega y lo empuja al scan
+        where = (
+            f"WHERE minx <= ST_XMax({env}) AND maxx >= ST_XMin({env}) "
+            f"AND miny <= ST_YMax({env}) AND maxy >= ST_YMin({env}) AND "
+        ) + where[len("WHERE "):]
+        params = params * 5
+    return where, params
+
+def zonal_edge_boxes(cells: list[tuple[int, int]], max_boxes: int) -> list[tuple[int, int, int, int]]:
+    """
+    Cajas (ix0, iy0, ix1, iy1) disjuntas que cubren las celdas de borde.
+    Se agrupan en franjas de h filas y, dentro de cada franja, en tramos
+    separados por más de h celdas vacías; h se dobla hasta no pasar de
+    max_boxes. Lo leído crece con el perímetro de la zona, no con su área.
+    """
+    h = 1
+    while True:
+        bands: dict[int, list[tuple[int, int]]] = {}
+        for ix, iy in cells:
+            bands.setdefault(iy // h, []).append((ix, iy))
+        boxes = []
+        for band in bands.values():
+            band.sort()
+            x0, y0, x1, y1 = band[0][0], band[0][1], band[0][0], band[0][1]
+            for ix, iy in band[1:]:
+                if ix > x1 + h:
+                    boxes.append((x0, y0, x1, y1))
+                    x0, y0, x1, y1 = ix, iy, ix, iy
+                else:
+                    x1, y0, y1 = ix, min(y0, iy), max(y1, iy)
+            boxes.append((x0, y0, x1, y1))
+        if len(boxes) <= max_boxes:
+            return boxes
+        h *= 2
+
+def zonal_stats(con: duckdb.DuckDBPyConnection, tbl: str, zone_expr: str, params: list) -> dict:
+    """
+    count/avg/min/max de la columna de valor de `tbl` dentro de la zona.
+
+    zone_expr es la geometría de la zona en el SRID de la tabla (con sus `?`).
+    Con pirámide se baja de nivel grueso a fino: las celdas cubiertas por la
+    zona se suman ya agregadas y solo los puntos de las celdas de borde del
+    nivel más fino se prueban con ST_Intersects. El resultado es exacto.
+    """
+    value, base = migrations.ZONAL_GRIDS[tbl]
+    if tbl not in ZONAL_GRID_TABLES:
+        rows = q(con, f"""
+            WITH zone_raw AS (SELECT {zone_expr} AS g),
+            zone AS (SELECT CASE WHEN ST_IsValid(g) THEN g ELSE ST_Buffer(g, 0) END AS g FROM zone_raw)
+            SELECT COUNT(*), SUM(t.{value}) / NULLIF(COUNT(t.{value}), 0), MIN(t.{value}), MAX(t.{value})
+            FROM {tbl} t, zone z
+            WHERE ST_Intersects(t.geom, z.g);
+        """, params)
+    else:
+        ratio, top = migrations.ZONAL_RATIO, migrations.ZONAL_LEVELS - 1
+        # margen para que el redondeo de floor() no deje un punto fuera de su celda
+        eps = base * 1e-6
+        levels = []
+        for k in range(top, -1, -1):
+            size = base * ratio ** k
+            cell = (f"ST_MakeEnvelope(c.ix * {size!r} - {eps!r}, c.iy * {size!r} - {eps!r}, "
+                    f"(c.ix + 1) * {size!r} + {eps!r}, (c.iy + 1) * {size!r} + {eps!r})")
+            parent = "" if k == top else (
+                f"JOIN lv{k + 1} p ON NOT p.cov "
+                f"AND p.ix = CAST(floor(c.ix / {ratio}) AS BIGINT) "
+                f"AND p.iy = CAST(floor(c.iy / {ratio}) AS BIGINT)"
+            )
+            levels.append(f"""lv{k} AS (
+              SELECT c.ix, c.iy, c.n, c.nv, c.s, c.mn, c.mx, ST_Covers(z.g, {cell}) AS cov
+              FROM zonal_grid c {parent}, zone z
+              WHERE c.tbl = '{tbl}' AND c.level = {k} AND ST_Intersects(z.g, {cell})
+            )""")
+        covered = " UNION ALL ".join(
+            f"SELECT n, nv, s, mn, mx FROM lv{k} WHERE cov" for k in range(top + 1)
+        )
+        sep = ",\n            "
+        # 1) descenso por la pirámide: agregado de las celdas cubiertas + celdas de borde de nivel 0
+        grid = q(con, f"""
+            WITH zone_raw AS (SELECT {zone_expr} AS g),
+            zone AS (SELECT CASE WHEN ST_IsValid(g) THEN g ELSE ST_Buffer(g, 0) END AS g FROM zone_raw),
+            {sep.join(levels)}
+            SELECT SUM(n), SUM(nv), SUM(s), MIN(mn), MAX(mx), NULL::BIGINT, NULL::BIGINT FROM ({covered})
+            UNION ALL
+            SELECT NULL, NULL, NULL, NULL, NULL, ix, iy FROM lv0 WHERE NOT cov;
+        """, params)
+        totals = next((r[:5] for r in grid if r[5] is None), (None,) * 5)
+        edges = [(r[5], r[6]) for r in grid if r[5] is not None]
+        rows = [(totals[0], totals[1], totals[2], totals[3], totals[4])]
+        if edges:
+            # 2) puntos solo de las celdas de borde: un escaneo con envolvente constante
+            #    (R-tree o minx..maxy) por caja; fx/fy hacen las cajas disjuntas y el
+            #    join con la lista de celdas descarta las cubiertas o vacías.
+            #    OFFSET 0 impide que DuckDB empuje el filtro fx/fy junto al de la
+            #    envolvente: con un filtro extra el escaneo por R-tree no se usa
+            fx = migrations.grid_cell_expr("ST_X(geom)", base)
+            fy = migrations.grid_cell_expr("ST_Y(geom)", base)
+            scans = []
+            for x0, y0, x1, y1 in zonal_edge_boxes(edges, ZONAL_EDGE_SCANS):
+                env = (f"ST_MakeEnvelope({x0 * base - eps!r}, {y0 * base - eps!r}, "
+                       f"{(x1 + 1) * base + eps!r}, {(y1 + 1) * base + eps!r})")
+                pre = ""
+                if tbl in BBOX_PREFILTER_TABLES:
+                    pre = (f"minx <= {(x1 + 1) * base + eps!r} AND maxx >= {x0 * base - eps!r} "
+                           f"AND miny <= {(y1 + 1) * base + eps!r} AND maxy >= {y0 * base - eps!r} AND ")
+                scans.append(f"""
+                  SELECT geom, v, {fx} AS fx, {fy} AS fy FROM (
+                    SELECT geom, CAST({value} AS DOUBLE) AS v
+                    FROM {tbl}
+                    WHERE {pre}ST_Intersects(geom, {env})
+                    OFFSET 0
+                  ) WHERE {fx} BETWEEN {x0} AND {x1} AND {fy} BETWEEN {y0} AND {y1}""")
+            part = q(con, f"""
+                WITH zone_raw AS (SELECT {zone_expr} AS g),
+                zone AS (SELECT CASE WHEN ST_IsValid(g) THEN g ELSE ST_Buffer(g, 0) END AS g FROM zone_raw),
+                edge AS (SELECT unnest(?::BIGINT[]) AS ix, unnest(?::BIGINT[]) AS iy),
+                pts AS ({" UNION ALL ".join(scans)})
+                SELECT COUNT(*), COUNT(t.v), SUM(t.v), MIN(t.v), MAX(t.v)
+                FROM pts t
+                SEMI JOIN edge e ON e.ix = t.fx AND e.iy = t.fy
+                JOIN zone z ON ST_Intersects(t.geom, z.g);
+            """, params + [[e[0] for e in edges], [e[1] for e in edges]])
+            rows.append(part[0])
+        agg = [r for r in rows if r[0]]
+        n = sum(r[0] for r in agg)
+        nv = sum(r[1] or 0 for r in agg)
+        rows = [(n, sum(r[2] or 0 for r in agg) / nv if nv else None,
+                 min((r[3] for r in agg if r[3] is not None), default=None),
+                 max((r[4] for r in agg if r[4] is not None), default=None))]
+    n, avg, mn, mx = rows[0] if rows else (0, None, None, None)
+    return {"count": int(n or 0),
+            "avg": float(avg) if avg is not None else None,
+            "min": float(mn) if mn is not None else None,
+            "max": float(mx) if mx is not None else None}
+
+def encode_cursor(key: int) -> str:
+    """Opaque keyset cursor (last rowid served)."""
+    return base64.urlsafe_b64encode(json.dumps({"k": int(key)}).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> int | None:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return int(json.loads(raw)["k"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(400, "cursor inválido")
+
+def paginate(source: str, table: str, bbox: str | None, limit: int, offset: int,
+             cursor: str | None, srid: int = 4326) -> tuple[str, list, int | None]:
+    """
+    Pages `source` (a "SELECT rowid AS _k, ... FROM table") filtered by `bbox`
+    (parse_bbox, or parse_bbox_for_srid when the table is not in EPSG:4326).
+
+    Without `cursor` it is the classic LIMIT/OFFSET. With `cursor` ("" for the
+    first page) rows are walked by rowid. On tables with minx/miny/maxx/maxy
+    (the Hilbert-ordered ones, so rowid order is spatial order) the page is
+    one scan in rowid order: `rowid > ?` and the bbox columns skip row groups
+    by zone map and the top-N stops the scan once it has `limit` rows, so a
+    page reads O(limit) rows wherever it is in the walk. Elsewhere the bbox
+    stays on the R-tree (alone in a subquery: OFFSET 0 keeps DuckDB from
+    merging `_k > ?` into it) and each page sorts all of its matches.
+    Returns (sql, params, page_limit); page_limit is None when not in keyset mode.
+    """
+    keyset = cursor is not None
+    where, params = (parse_bbox(bbox, table, prefilter=keyset) if srid == 4326
+                     else parse_bbox_for_srid(bbox, srid, table, prefilter=keyset))
+    if not keyset:
+        return f"{source} {where} LIMIT ? OFFSET ?", params + [limit, offset], None
+    if offset:
+        raise HTTPException(400, "cursor y offset no se pueden combinar")
+    key = decode_cursor(cursor)
+    if key is None:
+        sql = f"{source} {where}"
+    elif where and table not in BBOX_COLUMN_TABLES:
+        sql = f"SELECT * FROM ({source} {where} OFFSET 0) WHERE _k > ?"
+        params = params + [key]
+    else:
+        sql = f"{source} {where} {'AND' if where else 'WHERE'} rowid > ?"
+        params = params + [key]
+    return f"{sql} ORDER BY _k LIMIT ?", params + [limit], limit
+
+def bbox_probes(table: str) -> list[tuple[str, list]]:
+    """
+    The bbox queries the endpoints send to `table` that should use its R-tree:
+    bare filter, LIMIT/OFFSET page and, without bbox columns, a keyset page.
+    """
+    bbox = ",".join(map(str, migrations.PROBE_BBOX))
+    srid = migrations.NATIVE_SRIDS.get(table, 4326)
+    where, params = parse_bbox(bbox, table) if srid == 4326 else parse_bbox_for_srid(bbox, srid, table)
+    source = f"SELECT rowid AS _k, geom FROM {table}"
+    probes = [(f"SELECT geom FROM {table} {where}", params),
+              paginate(source, table, bbox, 100, 0, None, srid)[:2]]
+    if table not in BBOX_COLUMN_TABLES:
+        probes.append(paginate(source, table, bbox, 100, 0, encode_cursor(0), srid)[:2])
+    return probes
+
+# Informe de arranque: tablas espaciales sin R-tree (o con R-tree que el
+# planificador no usa en las consultas reales de los endpoints)
+try:
+    for r in migrations.spatial_index_report(DB_RW, bbox_probes):
+        if not r["used"]:
+            print(f"Índice espacial {'sin usar' if r['present'] else 'ausente'}: "
+                  f"{r['table']} ({r['index']}) -> python migrations.py")
+            if r["table"] in BBOX_COLUMN_TABLES:
+                BBOX_PREFILTER_TABLES.add(r["table"])
+except duckdb.Error as e:
+    print("No se pudo comprobar los índices espaciales:", e)
 
 def fc(features: list[dict]) -> dict:
     return {"type": "FeatureCollection", "features": features}
 
+# Propiedades = todas las columnas de la fila salvo la geometría
+# (sin las columnas auxiliares que añade migrations.py)
+_AUX_COLUMNS = ["geom", "_k", "ref_upper", "ref14", *migrations.BBOX_COLUMNS,
+                *(migrations.lod_column(i) for i in range(1, len(migrations.LOD_TOLERANCES) + 1))]
+ALL_COLUMNS = f"COLUMNS(c -> c NOT IN ({', '.join(repr(c) for c in _AUX_COLUMNS)}))"
+ALL_PROPS = f"to_json(struct_pack(*{ALL_COLUMNS}))"
+
+def lod_geom_column(table: str, zoom: int | None, tolerance: float | None) -> str:
+    """
+    Columna de geometría para el nivel de detalle pedido: la más simplificada
+    cuya tolerancia no supera `tolerance` (o el tamaño de píxel a ese `zoom`).
+    Sin parámetros, o sin columnas LOD en la tabla, la geometría completa.
+    """
+    if tolerance is None and zoom is not None:
+        tolerance = 360.0 / (256 * 2 ** zoom)  # grados por píxel en el ecuador
+    if tolerance is None or table not in LOD_TABLES:
+        return "geom"
+    col = "geom"
+    for level, tol in enumerate(migrations.LOD_TOLERANCES, 1):
+        if tol <= tolerance:
+            col = migrations.lod_column(level)
+    return col
+
+def feature_sql(geom: str, props: str) -> str:
+    """
+    SQL expression that renders a whole GeoJSON Feature as text inside DuckDB,
+    so Python only passes the string through (no json.loads / json.dumps).
+    """
+    return (
+        f"json_object('type', 'Feature', 'geometry', ST_AsGeoJSON({geom})::JSON, "
+        f"'properties', {props})::VARCHAR"
+    )
+
+# Formatos de los endpoints de features (parámetro ?format=)
+FEATURE_FORMAT_RE = "^(geojson|arrow|fgb)$"
+FEATURE_FORMAT_DOC = "geojson | arrow (Arrow IPC, geometría WKB/GeoArrow) | fgb (FlatGeobuf)"
+
+def feature_select(fmt: str, geom: str, props: dict[str, str] | None = None) -> str:
+    """
+    Final SELECT list of a features endpoint for the requested format:
+    a Feature rendered as text (geojson), or a `geometry` column plus one
+    column per property (WKB for arrow, GEOMETRY for fgb).
+    props maps property name -> SQL expression; None means every column.
+    """
+    if fmt == "geojson":
+        if props is None:
+            return feature_sql(geom, ALL_PROPS)
+        pairs = ", ".join(f"'{k}', {v}" for k, v in props.items())
+        return feature_sql(geom, f"json_object({pairs})")
+    cols = ALL_COLUMNS if props is None else ", ".join(f'{v} AS "{k}"' for k, v in props.items())
+    return f"{f'ST_AsWKB({geom})' if fmt == 'arrow' else geom} AS geometry, {cols}"
+
+FC_HEAD = '{"type":"FeatureCollection","features":['
+
+def _fc_tail(last_row, n_rows: int, page_limit: int | None) -> str:
+    """Closes the collection; in keyset mode adds next_cursor (null on the last page)."""
+    if page_limit is None:
+        return "]}"
+    nxt = encode_cursor(last_row[1]) if last_row is not None and n_rows >= page_limit else None
+    return '],"next_cursor":' + json.dumps(nxt) + "}"
+
+def fc_response(rows, page_limit: int | None = None) -> Response:
+    """
+    FeatureCollection from rows whose first column is a Feature rendered by
+    feature_sql() (and, in keyset mode, whose second column is the row key).
+    """
+    tail = _fc_tail(rows[-1] if rows else None, len(rows), page_limit)
+    return Response(FC_HEAD + ",".join(r[0] for r in rows) + tail, media_type="application/json")
+
+def stream_fc(batches, page_limit: int | None = None) -> StreamingResponse:
+    """
+    FeatureCollection written to the socket batch by batch: memory stays flat
+    whatever the limit and the first byte leaves before the scan has finished.
+    """
+    def body():
+        yield FC_HEAD
+        sep, last, n = "", None, 0
+        for rows in batches:
+            yield sep + ",".join(r[0] for r in rows)
+            sep, last, n = ",", rows[-1], n + len(rows)
+        yield _fc_tail(last, n, page_limit)
+    return StreamingResponse(body(), media_type="application/json")
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+FGB_MEDIA_TYPE = "application/flatgeobuf"
+
+class _ChunkSink:
+    """File-like sink for pyarrow.ipc: collects what the writer emits between reads."""
+    closed = False
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        out, self.chunks = b"".join(self.chunks), []
+        return out
+
+def arrow_response(con: duckdb.DuckDBPyConnection, sql: str, params: list,
+                   stream: bool = False, page_limit: int | None = None):
+    """
+    Arrow IPC stream straight from DuckDB's record batches. The `geometry`
+    column is tagged as geoarrow.wkb; the keyset column (_k) is not sent and
+    next_cursor travels in the X-Next-Cursor header (buffered mode only).
+    """
+    if pa is None:
+        raise HTTPException(406, "format=arrow no disponible: falta pyarrow en el servidor")
+    schema, batches = q_arrow(con, sql, params)
+    keep = [i for i, f in enumerate(schema) if f.name != "_k"]
+    fields = [schema.field(i) for i in keep]
+    fields = [f.with_metadata({"ARROW:extension:name": "geoarrow.wkb",
+                               "ARROW:extension:metadata": '{"crs":"EPSG:4326"}'})
+              if f.name == "geometry" else f for f in fields]
+    out_schema = pa.schema(fields)
+    k_idx = schema.get_field_index("_k")
+
+    def body(batch_iter):
+        sink = _ChunkSink()
+        with pa.ipc.new_stream(sink, out_schema) as writer:
+            yield sink.take()
+            for b in batch_iter:
+                writer.write_batch(pa.RecordBatch.from_arrays([b.column(i) for i in keep], schema=out_schema))
+                yield sink.take()
+        yield sink.take()
+
+    if stream:
+        return StreamingResponse(body(batches), media_type=ARROW_MEDIA_TYPE)
+    collected = list(batches)
+    headers = {}
+    if page_limit is not None:
+        n = sum(b.num_rows for b in collected)
+        last = collected[-1].column(k_idx)[-1].as_py() if n and k_idx >= 0 else None
+        headers["X-Next-Cursor"] = encode_cursor(last) if last is not None and n >= page_limit else ""
+    return Response(b"".join(body(collected)), media_type=ARROW_MEDIA_TYPE, headers=headers)
+
+def fgb_response(con: duckdb.DuckDBPyConnection, sql: str, params: list,
+                 page_limit: int | None = None) -> Response:
+    """FlatGeobuf written by the spatial extension's GDAL driver to a temp file."""
+    if page_limit is not None:
+        raise HTTPException(400, "cursor no soportado con format=fgb (usa offset)")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "features.fgb")
+        q(con, f"""
+            COPY (SELECT COLUMNS(c -> c != '_k') FROM ({sql.strip().rstrip(";")}))
+            TO '{path}' (FORMAT GDAL, DRIVER 'FlatGeobuf', SRS 'EPSG:4326');
+        """, params)
+        with open(path, "rb") as fh:
+            return Response(fh.read(), media_type=FGB_MEDIA_TYPE)
+
+def features_response(con: duckdb.DuckDBPyConnection, sql: str, params: list,
+                      stream: bool = False, page_limit: int | None = None, fmt: str = "geojson"):
+    """Runs a feature_select() query and returns it buffered or streamed in `fmt`."""
+    if fmt == "arrow":
+        return arrow_response(con, sql, params, stream, page_limit)
+    if fmt == "fgb":
+        return fgb_response(con, sql, params, page_limit)
+    if stream:
+        return stream_fc(q_batches(con, sql, params), page_limit)
+    return fc_response(q(con, sql, params), page_limit)
+
 # ============================================================
 # MODELS
 # ============================================================
@@ -188,6 +915,11 @@ def fc(features: list[dict]) -> dict:
 class ZonalReq(BaseModel):
     geometry: dict  # GeoJSON Polygon/MultiPolygon/Point/…
 
+class ZonalBatchReq(BaseModel):
+    type: str = "FeatureCollection"
+    features: list[dict]
+    percentiles: list[float] = []  # 0-100, p. ej. [50, 90]
+
 class SavePointReq(BaseModel):
     lon: float
     lat: float
@@ -197,18 +929,22 @@ class SavePointReq(BaseModel):
 class CelsWithinReq(BaseModel):
     geometry: dict  # GeoJSON geometry
 
+class BuildingRefsReq(BaseModel):
+    references: list[str]
+
 # ============================================================
 # BUFFERS
 # ============================================================
 
 def _select_buffers(con: duckdb.DuckDBPyConnection, where_sql: str, params: list) -> List[Tuple]:
+    props = "json_object('id', id, 'user_id', user_id, 'buffer_m', CAST(buffer_m AS DOUBLE))"
     sql = f"""
         WITH f AS (
           SELECT id, user_id, buffer_m, geom
           FROM point_buffers
           {where_sql}
         )
-        SELECT id, user_id, buffer_m, ST_AsGeoJSON(geom) AS geom_json
+        SELECT {feature_sql("geom", props)}
         FROM f;
     """
     return q(con, sql, params)
@@ -223,7 +959,53 @@ def visor_health():
         "db_path": DB_PATH
     }
 
+# Gauges leídos en cada scrape: caché de respuestas, colas y pool
+metrics.register(metrics.Gauge(
+    "emsv_response_cache_events_total", "Consultas a la caché de respuestas", ("result",),
+    lambda: [(("hit",), RESPONSE_CACHE.hits), (("miss",), RESPONSE_CACHE.misses),
+             (("coalesced",), RESPONSE_CACHE.coalesced)],
+    kind="counter"))
+metrics.register(metrics.Gauge(
+    "emsv_response_cache_bytes", "Bytes guardados en la caché de respuestas", (),
+    lambda: [((), RESPONSE_CACHE.size)]))
+metrics.register(metrics.Gauge(
+    "emsv_lane_waiting", "Peticiones esperando plaza por clase de consulta", ("lane",),
+    lambda: [((l.name,), l.waiting) for l in (HEAVY_LANE, LIGHT_LANE)]))
+metrics.register(metrics.Gauge(
+    "emsv_lane_rejected_total", "Peticiones rechazadas con 503 por clase de consulta", ("lane",),
+    lambda: [((l.name,), l.rejected) for l in (HEAVY_LANE, LIGHT_LANE)],
+    kind="counter"))
+metrics.register(metrics.Gauge(
+    "emsv_pool_idle_cursors", "Cursores libres en el pool de lectura", (),
+    lambda: [((), READ_POOL.idle)]))
+metrics.register(metrics.Gauge(
+    "emsv_address_index_entries", "Direcciones cargadas en el índice en memoria", (),
+    lambda: [((), ADDRESS_INDEX.size)]))
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def _require_admin(token: str | None) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(403, "Endpoints de administración deshabilitados (define ADMIN_TOKEN)")
+    if not hmac.compare_digest((token or "").encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(401, "Token de administración inválido")
+
+@app.get("/admin/slow_queries")
+def admin_slow_queries(
+    limit: int = Query(50, ge=1, le=1000),
+    x_admin_token: str | None = Header(None),
+):
+    """Consultas lentas recientes (más nuevas primero) con su plan EXPLAIN ANALYZE."""
+    _require_admin(x_admin_token)
+    return {"threshold_ms": SLOW_QUERY_MS, "queries": SLOW_QUERIES.entries(limit)}
 
+@app.delete("/admin/slow_queries")
+def admin_clear_slow_queries(x_admin_token: str | None = Header(None)):
+    _require_admin(x_admin_token)
+    SLOW_QUERIES.clear()
+    return {"ok": True}
 
 @app.get("/buffers")
 def get_buffers(
@@ -235,24 +1017,14 @@ def get_buffers(
     where_sql = ""
     params: list = []
     if bbox:
-        w, p = parse_bbox(bbox)
+        w, p = parse_bbox(bbox, "point_buffers")
         where_sql = f"{w} LIMIT ? OFFSET ?"
         params = p + [limit, offset]
     else:
         where_sql = "LIMIT ? OFFSET ?"
         params = [limit, offset]
 
-    rows = _select_buffers(con, where_sql, params)
-    features = [{
-        "type": "Feature",
-        "geometry": json.loads(gjson) if isinstance(gjson, str) else gjson,
-        "properties": {
-            "id": rid,
-            "user_id": ruser,
-            "buffer_m": float(rbuf) if rbuf is not None else None
-        }
-    } for rid, ruser, rbuf, gjson in rows]
-    return fc(features)
+    return fc_response(_select_buffers(con, where_sql, params))
 
 # ============================================================
 # POINTS
@@ -280,6 +1052,7 @@ def save_point(
     except Exception as e:
         con.execute("ROLLBACK")
         raise HTTPException(500, f"Insert failed: {e}")
+    bump_data_version("points")
     return {"ok": True, "id": new_id}
 
 
@@ -289,7 +1062,7 @@ def points_count(
     bbox: str | None = None,
     con: duckdb.DuckDBPyConnection = Depends(get_conn),
 ):
-    where, params = parse_bbox(bbox)
+    where, params = parse_bbox(bbox, "big_points")
     cnt = q(con, f"SELECT COUNT(*) FROM big_points {where};", params)[0][0]
     return {"count": int(cnt)}
 
@@ -298,24 +1071,19 @@ def points_features(
     bbox: str | None = Query(None),
     limit: int = 2000,
     offset: int = 0,
-    con: duckdb.DuckDBPyConnection = Depends(get_conn),
+    cursor: str | None = Query(None, description="Cursor keyset ('' = primera página)"),
+    fmt: str = Query("geojson", alias="format", pattern=FEATURE_FORMAT_RE, description=FEATURE_FORMAT_DOC),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
 ):
-    where, params = parse_bbox(bbox)
-    rows = q(con, f"""
+    page, params, page_limit = paginate(
+        "SELECT rowid AS _k, * FROM big_points", "big_points", bbox, limit, offset, cursor)
+    sql = f"""
         WITH f AS (
-          SELECT geom, * EXCLUDE (geom)
-          FROM big_points
-          {where}
-          LIMIT ? OFFSET ?
+          {page}
         )
-        SELECT ST_AsGeoJSON(geom), to_json(f) FROM f;
-    """, params + [limit, offset])
-
-    feats = [
-        {"type": "Feature", "geometry": json.loads(g), "properties": json.loads(p) if isinstance(p, str) else {}}
-        for g, p in rows
-    ]
-    return fc(feats)
+        SELECT {feature_select(fmt, "geom")}, _k FROM f;
+    """
+    return features_response(con, sql, params, page_limit=page_limit, fmt=fmt)
 
 # ============================================================
 # SHADOWS
@@ -327,51 +1095,31 @@ def shadows_features(
     limit: int = 500000,
     offset: int = 0,
     table: str = Query("shadows", description="Nombre de tabla de sombras"),
-    con: duckdb.DuckDBPyConnection = Depends(get_conn),
+    stream: bool = Query(False, description="Envía el FeatureCollection por lotes"),
+    cursor: str | None = Query(None, description="Cursor keyset ('' = primera página)"),
+    fmt: str = Query("geojson", alias="format", pattern=FEATURE_FORMAT_RE, description=FEATURE_FORMAT_DOC),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
 ):
     tbl = _shadow_table_or_400(table)
-    where, params = parse_bbox(bbox)
-
     # Asumimos columnas: geom (GEOMETRY) y shadow_count (NUMERIC)
-    rows = q(con, f"""
+    page, params, page_limit = paginate(
+        f"SELECT rowid AS _k, geom, shadow_count FROM {tbl}", tbl, bbox, limit, offset, cursor)
+    sql = f"""
         WITH f AS (
-          SELECT geom, shadow_count
-          FROM {tbl}
-          {where}
-          LIMIT ? OFFSET ?
+          {page}
         )
-        SELECT ST_AsGeoJSON(geom), shadow_count FROM f;
-    """, params + [limit, offset])
-
-    feats = [
-        {"type": "Feature", "geometry": json.loads(g),
-         "properties": {"shadow_count": float(s) if s is not None else None}}
-        for g, s in rows
-    ]
-    return {"type": "FeatureCollection", "features": feats}
+        SELECT {feature_select(fmt, "geom", {"shadow_count": "CAST(shadow_count AS DOUBLE)"})}, _k FROM f;
+    """
+    return features_response(con, sql, params, stream, page_limit, fmt)
 
 @app.post("/shadows/zonal")
 def shadows_zonal(
     req: ZonalReq,
     table: str = Query("shadows", description="Nombre de tabla de sombras"),
-    con: duckdb.DuckDBPyConnection = Depends(get_conn)
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy)
 ):
     tbl = _shadow_table_or_400(table)
-    geojson = json.dumps(req.geometry)
-    rows = q(con, f"""
-        WITH zone_raw AS (SELECT ST_GeomFromGeoJSON(?::VARCHAR) AS g),
-        zone AS (SELECT CASE WHEN ST_IsValid(g) THEN g ELSE ST_Buffer(g, 0) END AS g FROM zone_raw),
-        hits AS (
-          SELECT s.shadow_count FROM {tbl} s, zone z
-          WHERE ST_Intersects(s.geom, z.g)
-        )
-        SELECT COALESCE(COUNT(*),0), AVG(shadow_count), MIN(shadow_count), MAX(shadow_count) FROM hits;
-    """, [geojson])
-    n, avg, mn, mx = rows[0] if rows else (0, None, None, None)
-    return {"count": int(n or 0),
-            "avg": float(avg) if avg is not None else None,
-            "min": float(mn) if mn is not None else None,
-            "max": float(mx) if mx is not None else None}
+    return zonal_stats(con, tbl, "ST_GeomFromGeoJSON(?::VARCHAR)", [json.dumps(req.geometry)])
 
 # ============================================================
 # IRRADIANCE
@@ -382,65 +1130,205 @@ def irradiance_features(
     bbox: str | None = Query(None),
     limit: int = Query(5000, ge=1, le=100000),
     offset: int = Query(0, ge=0),
-    con: duckdb.DuckDBPyConnection = Depends(get_conn_ro),
+    stream: bool = Query(False, description="Envía el FeatureCollection por lotes"),
+    cursor: str | None = Query(None, description="Cursor keyset ('' = primera página)"),
+    fmt: str = Query("geojson", alias="format", pattern=FEATURE_FORMAT_RE, description=FEATURE_FORMAT_DOC),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
 ):
     # Filtrado en el SRID nativo para acelerar la intersección
-    where, params = parse_bbox_for_srid(bbox, 25830)
+    page, params, page_limit = paginate(
+        "SELECT rowid AS _k, geom, value FROM irr_points", "irr_points", bbox, limit, offset, cursor,
+        srid=25830)
 
-    rows = q(
-        con,
-        f"""
+    sql = f"""
         WITH f AS (
-          SELECT geom, value
-          FROM irr_points
-          {where}
-          LIMIT ? OFFSET ?
+          {page}
         )
-        SELECT
-          ST_AsGeoJSON(
-            ST_Transform(geom, 'EPSG:25830','EPSG:4326', TRUE)
-          ) AS gjson,
-          value
+        SELECT {feature_select(
+            fmt,
+            "ST_Transform(geom, 'EPSG:25830','EPSG:4326', TRUE)",
+            {"value": "CAST(value AS DOUBLE)"},
+        )}, _k
         FROM f;
-        """,
-        params + [limit, offset],
-    )
-
-    feats = [
-        {
-            "type": "Feature",
-            "geometry": json.loads(g),
-            "properties": {"value": float(v) if v is not None else None},
-        }
-        for g, v in rows
-    ]
-    return {"type": "FeatureCollection", "features": feats}
+        """
+    return features_response(con, sql, params, stream, page_limit, fmt)
 
 @app.post("/irradiance/zonal")
-def irradiance_zonal(req: ZonalReq, con: duckdb.DuckDBPyConnection = Depends(get_conn)):
-    geojson = json.dumps(req.geometry)
-    rows = q(con, """
-        WITH zone AS (
-          SELECT ST_Transform(
-            ST_GeomFromGeoJSON(?::VARCHAR),
-            'EPSG:4326','EPSG:25830', TRUE
-          ) AS g
+def irradiance_zonal(req: ZonalReq, con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy)):
+    zone = "ST_Transform(ST_GeomFromGeoJSON(?::VARCHAR), 'EPSG:4326', 'EPSG:25830', TRUE)"
+    return zonal_stats(con, "irr_points", zone, [json.dumps(req.geometry)])
+
+# ============================================================
+# ZONAL (BATCH)
+# ============================================================
+
+def zonal_stats_batch(con: duckdb.DuckDBPyConnection, tbl: str, srid: int, req: ZonalBatchReq) -> dict:
+    """
+    Estadística zonal de todas las geometrías de un FeatureCollection en una
+    sola consulta: join espacial puntos × zonas y agregado por zona.
+    """
+    if not req.features:
+        raise HTTPException(400, "FeatureCollection sin features")
+    if len(req.features) > ZONAL_BATCH_MAX:
+        raise HTTPException(400, f"Máximo {ZONAL_BATCH_MAX} features por petición")
+    if any(not 0 <= p <= 100 for p in req.percentiles):
+        raise HTTPException(400, "percentiles debe estar entre 0 y 100")
+    geoms = []
+    for f in req.features:
+        g = f.get("geometry") if isinstance(f, dict) else None
+        if not g:
+            raise HTTPException(400, "Feature sin geometry")
+        geoms.append(json.dumps(g))
+
+    value, _ = migrations.ZONAL_GRIDS[tbl]
+    zone = "ST_GeomFromGeoJSON(gj)"
+    if srid != 4326:
+        zone = f"ST_Transform({zone}, 'EPSG:4326', 'EPSG:{srid}', TRUE)"
+    pct_sql, params = "", [geoms]
+    if req.percentiles:
+        pct_sql = ", quantile_cont(h.v, ?::DOUBLE[])"
+        params.append([p / 100 for p in req.percentiles])
+
+    rows = q(con, f"""
+        WITH zone_raw AS (
+          SELECT generate_subscripts(l, 1) - 1 AS i, unnest(l) AS gj
+          FROM (SELECT ?::VARCHAR[] AS l)
         ),
+        zone AS (SELECT i, {zone} AS g FROM zone_raw),
         zone_ok AS (
-          SELECT CASE WHEN ST_IsValid(g) THEN g ELSE ST_Buffer(g,0) END AS g FROM zone
+          SELECT i, CASE WHEN ST_IsValid(g) THEN g ELSE ST_Buffer(g, 0) END AS g FROM zone
         ),
         hits AS (
-          SELECT p.value FROM irr_points p, zone_ok z WHERE ST_Intersects(p.geom, z.g)
+          SELECT z.i, CAST(t.{value} AS DOUBLE) AS v
+          FROM {tbl} t
+          JOIN zone_ok z ON ST_Intersects(t.geom, z.g)
         )
-        SELECT COALESCE(COUNT(*),0), AVG(value), MIN(value), MAX(value) FROM hits;
-    """, [geojson])
-    n, avg, mn, mx = rows[0] if rows else (0, None, None, None)
-    return {
-        "count": int(n or 0),
-        "avg": float(avg) if avg is not None else None,
-        "min": float(mn) if mn is not None else None,
-        "max": float(mx) if mx is not None else None,
-    }
+        SELECT z.i, COUNT(h.i), AVG(h.v), MIN(h.v), MAX(h.v){pct_sql}
+        FROM zone_ok z
+        LEFT JOIN hits h ON h.i = z.i
+        GROUP BY z.i
+        ORDER BY z.i;
+    """, params)
+
+    def num(x):
+        return float(x) if x is not None else None
+
+    results = []
+    for r in rows:
+        i = int(r[0])
+        f = req.features[i]
+        item = {"index": i, "id": f.get("id"), "properties": f.get("properties") or {},
+                "count": int(r[1] or 0), "avg": num(r[2]), "min": num(r[3]), "max": num(r[4])}
+        if req.percentiles:
+            qs = r[5] or [None] * len(req.percentiles)
+            item["percentiles"] = {f"p{p:g}": num(v) for p, v in zip(req.percentiles, qs)}
+        results.append(item)
+    return {"count": len(results), "results": results}
+
+@app.post("/shadows/zonal/batch")
+def shadows_zonal_batch(
+    req: ZonalBatchReq,
+    table: str = Query("shadows", description="Nombre de tabla de sombras"),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy)
+):
+    return zonal_stats_batch(con, _shadow_table_or_400(table), 4326, req)
+
+@app.post("/irradiance/zonal/batch")
+def irradiance_zonal_batch(req: ZonalBatchReq, con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy)):
+    return zonal_stats_batch(con, "irr_points", 25830, req)
+
+# ============================================================
+# AGGREGATE (celdas cuadradas para zoom bajo)
+# ============================================================
+
+METERS_PER_DEGREE = 111_320.0
+
+def aggregate_bins(con: duckdb.DuckDBPyConnection, tbl: str, srid: int, bbox: str,
+                   resolution: float | None, max_bins: int) -> Response:
+    """
+    FeatureCollection de celdas cuadradas (count/mean/min/max del valor) en el bbox.
+
+    Las celdas son las de la pirámide zonal (lado base·4^k en el SRID nativo):
+    se elige el primer nivel con lado >= resolution (metros) y se sube de nivel
+    hasta que el bbox quepa en max_bins celdas, así que el tamaño de la
+    respuesta depende de la pantalla y no de la densidad de puntos. Como mucho
+    se sube hasta el último nivel de la pirámide; si aun así no cabe, 400.
+    """
+    value, base = migrations.ZONAL_GRIDS[tbl]
+    ratio, top = migrations.ZONAL_RATIO, migrations.ZONAL_LEVELS - 1
+    minx, miny, maxx, maxy = bbox_values(bbox)
+    if srid != 4326:
+        minx, miny, maxx, maxy = q(con, f"""
+            SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+            FROM (SELECT ST_Transform(ST_MakeEnvelope(?, ?, ?, ?), 'EPSG:4326', 'EPSG:{srid}', TRUE) AS e);
+        """, [minx, miny, maxx, maxy])[0]
+    if maxx < minx or maxy < miny:
+        raise HTTPException(400, "bbox vacío")
+
+    want = (resolution or 0) / (METERS_PER_DEGREE if srid == 4326 else 1.0)
+    n_bins = lambda size: ((maxx - minx) / size + 1) * ((maxy - miny) / size + 1)
+    level = 0
+    while level < top and base * ratio ** level < want:
+        level += 1
+    while level < top and n_bins(base * ratio ** level) > max_bins:
+        level += 1
+    size = base * ratio ** level
+    if n_bins(size) > max_bins:
+        raise HTTPException(400, f"bbox demasiado grande: más de {max_bins} celdas de {size} en EPSG:{srid}")
+
+    if tbl in ZONAL_GRID_TABLES:
+        # se agrega desde la pirámide (nunca se leen los puntos)
+        bins_sql = f"""
+            SELECT ix AS cx, iy AS cy,
+                   n, s / NULLIF(nv, 0) AS mean, mn, mx
+            FROM zonal_grid
+            WHERE tbl = '{tbl}' AND level = {level}
+              AND ix BETWEEN ? AND ? AND iy BETWEEN ? AND ?
+        """
+        params = [math.floor(minx / size), math.floor(maxx / size),
+                  math.floor(miny / size), math.floor(maxy / size)]
+    else:
+        where, params = (parse_bbox(bbox, tbl) if srid == 4326
+                         else parse_bbox_for_srid(bbox, srid, tbl))
+        bins_sql = f"""
+            SELECT {migrations.grid_cell_expr("ST_X(geom)", size)} AS cx,
+                   {migrations.grid_cell_expr("ST_Y(geom)", size)} AS cy,
+                   COUNT(*) AS n, AVG({value}) AS mean, MIN({value}) AS mn, MAX({value}) AS mx
+            FROM {tbl}
+            {where}
+            GROUP BY ALL
+        """
+    cell = (f"ST_MakeEnvelope(cx * {size!r}, cy * {size!r}, "
+            f"(cx + 1) * {size!r}, (cy + 1) * {size!r})")
+    if srid != 4326:
+        cell = f"ST_Transform({cell}, 'EPSG:{srid}', 'EPSG:4326', TRUE)"
+    rows = q(con, f"""
+        WITH bins AS ({bins_sql})
+        SELECT {feature_sql(cell, f"json_object('count', n, 'mean', CAST(mean AS DOUBLE), "
+                                  f"'min', CAST(mn AS DOUBLE), 'max', CAST(mx AS DOUBLE))")}
+        FROM bins
+        WHERE n > 0;
+    """, params)
+    return fc_response(rows)
+
+@app.get("/irradiance/aggregate")
+def irradiance_aggregate(
+    bbox: str = Query(..., description="minx,miny,maxx,maxy (WGS84)"),
+    resolution: float | None = Query(None, gt=0, description="Lado mínimo de celda en metros"),
+    max_bins: int = Query(AGG_MAX_BINS, ge=1, le=AGG_MAX_BINS),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
+):
+    return aggregate_bins(con, "irr_points", 25830, bbox, resolution, max_bins)
+
+@app.get("/shadows/aggregate")
+def shadows_aggregate(
+    bbox: str = Query(..., description="minx,miny,maxx,maxy (WGS84)"),
+    resolution: float | None = Query(None, gt=0, description="Lado mínimo de celda en metros"),
+    max_bins: int = Query(AGG_MAX_BINS, ge=1, le=AGG_MAX_BINS),
+    table: str = Query("shadows", description="Nombre de tabla de sombras"),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
+):
+    return aggregate_bins(con, _shadow_table_or_400(table), 4326, bbox, resolution, max_bins)
 
 # ============================================================
 # BUILDINGS + METRICS
@@ -451,60 +1339,67 @@ def buildings_features(
     bbox: str | None = Query(None),
     limit: int = 50000,
     offset: int = 0,
-    con: duckdb.DuckDBPyConnection = Depends(get_conn_ro),
+    stream: bool = Query(False, description="Envía el FeatureCollection por lotes"),
+    zoom: int | None = Query(None, ge=0, le=24, description="Zoom del mapa (elige el nivel de detalle)"),
+    tolerance: float | None = Query(None, ge=0, description="Tolerancia de simplificación en grados"),
+    fmt: str = Query("geojson", alias="format", pattern=FEATURE_FORMAT_RE, description=FEATURE_FORMAT_DOC),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
 ):
-    where, params = parse_bbox(bbox)
-    rows = q(con, f"""
+    where, params = parse_bbox(bbox, "buildings")
+    geom = lod_geom_column("buildings", zoom, tolerance)
+    sql = f"""
         WITH f AS (
-          SELECT geom, * EXCLUDE (geom)
+          SELECT *
           FROM buildings
           {where}
           LIMIT ? OFFSET ?
         )
-        SELECT ST_AsGeoJSON(geom), to_json(f) FROM f;
-    """, params + [limit, offset])
-    feats = [
-        {"type": "Feature", "geometry": json.loads(g), "properties": json.loads(p) if isinstance(p, str) else {}}
-        for g, p in rows
-    ]
-    return fc(feats)
+        SELECT {feature_select(fmt, geom)} FROM f;
+    """
+    return features_response(con, sql, params + [limit, offset], stream, fmt=fmt)
 
 @app.get("/buildings/irradiance")
 def buildings_irradiance(
     bbox: str | None = Query(None),
     limit: int = 50000,
     offset: int = 0,
-    con: duckdb.DuckDBPyConnection = Depends(get_conn),
+    cursor: str | None = Query(None, description="Cursor keyset ('' = primera página)"),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
 ):
-    where, params = parse_bbox(bbox)
+    # se pagina sobre buildings y la métrica se une a la página
+    page, params, page_limit = paginate(
+        f"SELECT rowid AS _k, geom, reference, {ref_upper_sql('buildings')} AS ref_u FROM buildings", "buildings", bbox,
+        limit, offset, cursor)
     rows = q(con, f"""
         WITH f AS (
-          SELECT b.geom, b.reference, m.irr_mean_kWhm2_y, m.irr_average
-          FROM buildings b
-          LEFT JOIN edificios_metrics m ON UPPER(b.reference)=UPPER(m.reference)
-          {where}
-          LIMIT ? OFFSET ?
+          {page}
         )
-        SELECT ST_AsGeoJSON(geom), reference, irr_mean_kWhm2_y, irr_average FROM f;
-    """, params + [limit, offset])
-    feats = []
-    for g, ref, irr_mean, irr_avg in rows:
-        v = irr_mean if irr_mean is not None else irr_avg
-        feats.append({
-            "type": "Feature",
-            "geometry": json.loads(g),
-            "properties": {"reference": ref, "irr_building": float(v) if v is not None else None},
-        })
-    return fc(feats)
+        SELECT {feature_sql(
+            "f.geom",
+            "json_object('reference', f.reference, "
+            "'irr_building', CAST(COALESCE(m.irr_mean_kWhm2_y, m.irr_average) AS DOUBLE))",
+        )}, f._k
+        FROM f
+        LEFT JOIN edificios_metrics m ON f.ref_u = {ref_upper_sql("edificios_metrics", "m")}
+        ORDER BY f._k;
+    """, params)
+    return fc_response(rows, page_limit)
+
+BUILDING_METRICS = ("irr_average", "area_m2", "superficie_util_m2", "pot_kWp",
+                    "energy_total_kWh", "factor_capacidad_pct", "irr_mean_kWhm2_y")
+
+def metrics_json_sql(alias: str) -> str:
+    """edificios_metrics row as a JSON object with the keys of /buildings/metrics."""
+    return "json_object(" + ", ".join(f"'{c}', CAST({alias}.{c} AS DOUBLE)" for c in BUILDING_METRICS) + ")"
 
 @app.get("/buildings/metrics")
 def buildings_metrics(reference: str, con: duckdb.DuckDBPyConnection = Depends(get_conn)):
     ref = reference.strip()
-    rows = q(con, """
+    rows = q(con, f"""
         SELECT reference,
                irr_average, area_m2, superficie_util_m2, pot_kWp,
                energy_total_kWh, factor_capacidad_pct, irr_mean_kWhm2_y
-        FROM edificios_metrics WHERE UPPER(reference)=UPPER(?) LIMIT 1;
+        FROM edificios_metrics WHERE {ref_upper_sql("edificios_metrics")} = UPPER(?) LIMIT 1;
     """, [ref])
     if not rows:
         raise HTTPException(404, "No metrics for this reference")
@@ -528,25 +1423,71 @@ def building_by_reference(
     con: duckdb.DuckDBPyConnection = Depends(get_conn),
 ):
     ref_norm = ref.strip()
-    rows = q(con, """
+    rows = q(con, f"""
         WITH f AS (
-          SELECT geom, * EXCLUDE (geom)
+          SELECT *
           FROM buildings
-          WHERE UPPER(reference) = UPPER(?)
+          WHERE {ref_upper_sql("buildings")} = UPPER(?)
           LIMIT 1
         )
-        SELECT ST_AsGeoJSON(geom), to_json(f) FROM f;
+        SELECT {feature_sql("geom", ALL_PROPS)} FROM f;
     """, [ref_norm])
 
     if not rows:
         raise HTTPException(404, "Referencia no encontrada")
 
-    gjson, props = rows[0]
-    return {
-        "type": "Feature",
-        "geometry": json.loads(gjson),
-        "properties": json.loads(props) if isinstance(props, str) else (props or {})
-    }
+    return Response(rows[0][0], media_type="application/json")
+
+@app.post("/buildings/by_refs")
+def buildings_by_references(
+    req: BuildingRefsReq,
+    include_metrics: bool = Query(True, description="Añade edificios_metrics en la clave metrics"),
+    include_geometry: bool = Query(True, description="Sin geometría: solo propiedades (geometry null)"),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
+):
+    """
+    Batch variant of /buildings/by_ref, /cadastre/feature and /buildings/metrics:
+    up to BUILDINGS_BATCH_MAX references (case-insensitive, like ref_upper = UPPER(?))
+    resolved in one query. FeatureCollection in request order (duplicates
+    collapsed) plus "missing", the references with no building. Metrics are
+    looked up on their own (a reference may have metrics and no building):
+    "metrics": {"found": {reference: {...}}, "missing": [...]}.
+    """
+    refs = list(dict.fromkeys(r.strip().upper() for r in req.references if r and r.strip()))
+    if not refs:
+        raise HTTPException(400, "Sin referencias")
+    if len(refs) > BUILDINGS_BATCH_MAX:
+        raise HTTPException(400, f"Máximo {BUILDINGS_BATCH_MAX} referencias por petición")
+
+    rows = q(con, f"""
+        WITH refs AS (
+          SELECT generate_subscripts(l, 1) AS i, unnest(l) AS ref_u
+          FROM (SELECT ?::VARCHAR[] AS l)
+        ),
+        b AS (
+          SELECT * FROM buildings WHERE {ref_upper_sql("buildings")} IN (SELECT ref_u FROM refs)
+        ),
+        f AS (
+          SELECT {ref_upper_sql("buildings")} AS ref_b, {"geom" if include_geometry else "NULL::GEOMETRY AS geom"},
+                 to_json(struct_pack(*{ALL_COLUMNS})) AS props
+          FROM b
+        )
+        SELECT refs.ref_u,
+               CASE WHEN f.ref_b IS NOT NULL THEN {feature_sql("f.geom", "f.props")} END,
+               {f"CASE WHEN m.reference IS NOT NULL THEN {metrics_json_sql('m')} END" if include_metrics else "NULL"}
+        FROM refs
+        LEFT JOIN f ON f.ref_b = refs.ref_u
+        {f"LEFT JOIN edificios_metrics m ON {ref_upper_sql('edificios_metrics', 'm')} = refs.ref_u" if include_metrics else ""}
+        QUALIFY row_number() OVER (PARTITION BY refs.i) = 1
+        ORDER BY refs.i;
+    """, [refs])
+
+    missing = [r[0] for r in rows if r[1] is None]
+    body = FC_HEAD + ",".join(r[1] for r in rows if r[1] is not None) + '],"missing":' + json.dumps(missing)
+    if include_metrics:
+        found = ",".join(f"{json.dumps(r[0])}:{r[2]}" for r in rows if r[2] is not None)
+        body += ',"metrics":{"found":{' + found + '},"missing":' + json.dumps([r[0] for r in rows if r[2] is None]) + "}"
+    return Response(body + "}", media_type="application/json")
 
 # ============================================================
 # ADDRESS LOOKUP
@@ -559,30 +1500,23 @@ def lookup_address(
     include_feature: bool = False,
     con: duckdb.DuckDBPyConnection = Depends(get_conn),
 ):
-    def norm(s: str) -> str:
-        s = "" if s is None else s
-        s = unicodedata.normalize("NFD", s)
-        s = "".join(ch for ch in s if unicodedata.category(ch) != "Mn")
-        s = s.upper().strip()
-        for p in ["CALLE ", "CL ", "C/ ", "AVENIDA ", "AV ", "AV.", "PASEO ", "PS ", "PLAZA ", "PZA "]:
-            if s.startswith(p):
-                s = s[len(p):]
-        return " ".join(s.split())
-
-    street_norm = norm(street)
-    number_norm = norm(number)
-
-    row = q(con, """
-        SELECT reference
-        FROM address_index
-        WHERE street_norm = ? AND number_norm = ?
-        LIMIT 1;
-    """, [street_norm, number_norm])
+    street_norm = addresses.normalize(street)
+    number_norm = addresses.normalize(number)
 
-    if not row:
+    if ADDRESS_INDEX.loaded:
+        reference = ADDRESS_INDEX.lookup(street_norm, number_norm)
+    else:
+        row = q(con, """
+            SELECT reference
+            FROM address_index
+            WHERE street_norm = ? AND number_norm = ?
+            LIMIT 1;
+        """, [street_norm, number_norm])
+        reference = row[0][0] if row else None
+
+    if reference is None:
         raise HTTPException(404, "Dirección no encontrada")
 
-    reference = row[0][0]
     if not include_feature:
         return {"reference": reference}
 
@@ -599,6 +1533,170 @@ def lookup_address(
         feature = {"type": "Feature", "geometry": json.loads(gjson_str), "properties": {"reference": ref_val}}
     return {"reference": reference, "feature": feature}
 
+@app.get("/address/suggest")
+async def suggest_address(
+    text: str = Query(..., alias="q", min_length=1, description="Calle y, opcionalmente, número (texto parcial)"),
+    limit: int = Query(10, ge=1, le=50),
+):
+    # solo memoria (sin DuckDB ni threadpool): async para no pagar el salto de hilo
+    if not ADDRESS_INDEX.loaded:
+        raise HTTPException(503, "Índice de direcciones no disponible")
+    return {"query": text, "suggestions": [s._asdict() for s in ADDRESS_INDEX.suggest(text, limit)]}
+
+# ============================================================
+# GEOCODIFICACIÓN MASIVA (direcciones / referencias -> edificios)
+# ============================================================
+
+# Cabeceras aceptadas en el CSV (normalizadas, en minúsculas) -> campo
+GEOCODE_FIELDS = {
+    "id": "id",
+    "reference": "reference", "referencia": "reference", "ref": "reference",
+    "refcat": "reference", "referencia_catastral": "reference",
+    "street": "street", "calle": "street", "via": "street",
+    "number": "number", "numero": "number", "num": "number", "portal": "number",
+    "address": "address", "direccion": "address",
+}
+
+async def _raw_body(request: Request) -> bytes:
+    return await request.body()
+
+def _geocode_input(body: bytes, content_type: str) -> list:
+    """Rows of a JSON list (bare or as {"rows": [...]}) or of a CSV with a header row."""
+    if "csv" in content_type or "text/plain" in content_type:
+        try:
+            text = body.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            text = body.decode("latin-1")  # exportaciones de Excel en Windows
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(io.StringIO(text), dialect)
+        header = next(reader, None)
+        if not header:
+            raise HTTPException(400, "CSV vacío")
+        fields = [GEOCODE_FIELDS.get(addresses.normalize(h).lower().replace(" ", "_")) for h in header]
+        if not {"reference", "street", "address"} & set(fields):
+            raise HTTPException(400, "El CSV necesita una columna reference, street + number o address")
+        return [{f: v for f, v in zip(fields, rec) if f} for rec in reader if any(v.strip() for v in rec)]
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPException(400, "JSON inválido")
+    if isinstance(data, dict):
+        data = data.get("rows")
+    if not isinstance(data, list):
+        raise HTTPException(400, 'Se espera una lista de filas o {"rows": [...]}')
+    return data
+
+def _geocode_row(r) -> tuple:
+    """(id, reference, street_norm, number_norm, error) of one input row."""
+    if not isinstance(r, dict):
+        return None, None, None, None, "la fila no es un objeto"
+    ref = str(r.get("reference") or "").strip().upper() or None
+    street, number = r.get("street"), r.get("number")
+    if not ref and not street and r.get("address"):
+        street, number = addresses.split_number(addresses.normalize(str(r["address"])))
+    street = addresses.normalize(str(street)) if street else None
+    number = addresses.normalize(str(number)) if number not in (None, "") else None
+    if ref:
+        return r.get("id"), ref, None, None, None
+    if street and number:
+        return r.get("id"), None, street, number, None
+    return r.get("id"), None, None, None, "falta reference o street + number"
+
+@app.post("/geocode/batch", openapi_extra={"requestBody": {"required": True, "content": {
+    "application/json": {"schema": {"type": "array", "items": {"type": "object"}}},
+    "text/csv": {"schema": {"type": "string"}},
+}}})
+def geocode_batch(
+    include_feature: bool = Query(False, description="Incluir la geometría GeoJSON del edificio"),
+    body: bytes = Depends(_raw_body),
+    content_type: str | None = Header(None),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
+):
+    """
+    Resolves up to GEOCODE_BATCH_MAX addresses / cadastral references in one
+    set-based query (address_index -> buildings -> edificios_metrics).
+
+    Body: JSON list of {id?, reference} | {id?, street, number} | {id?, address},
+    or a CSV with those columns (also in Spanish: referencia, calle, numero…).
+    Response: NDJSON, one line per input row and in input order, with
+    status ok | address_not_found | building_not_found | invalid.
+    A 14-character reference that matches no building falls back to the
+    buildings of that parcel (match: "parcel").
+    """
+    parsed = [_geocode_row(r) for r in _geocode_input(body, (content_type or "").lower())]
+    if not parsed:
+        raise HTTPException(400, "Sin filas")
+    if len(parsed) > GEOCODE_BATCH_MAX:
+        raise HTTPException(400, f"Máximo {GEOCODE_BATCH_MAX} filas por petición")
+
+    geom_agg = ", arg_min(b.geom, b.reference) AS geom" if include_feature else ", NULL AS geom"
+    feature = feature_sql("h.geom", "json_object('reference', h.reference)") if include_feature else "NULL"
+    sql = f"""
+        WITH inp AS (
+          SELECT generate_subscripts(r, 1) - 1 AS i, unnest(r) AS ref, unnest(s) AS street, unnest(n) AS num
+          FROM (SELECT ?::VARCHAR[] AS r, ?::VARCHAR[] AS s, ?::VARCHAR[] AS n)
+        ),
+        addr AS (
+          SELECT inp.i, MIN(a.reference) AS reference
+          FROM inp
+          JOIN address_index a ON a.street_norm = inp.street AND a.number_norm = inp.num
+          GROUP BY inp.i
+        ),
+        res AS (
+          SELECT inp.i, addr.reference AS addr_ref, COALESCE(inp.ref, UPPER(addr.reference)) AS ref_u
+          FROM inp LEFT JOIN addr USING (i)
+        ),
+        exact AS (
+          SELECT res.i, MIN(b.reference) AS reference{geom_agg}, 'exact' AS how
+          FROM res JOIN buildings b ON {ref_upper_sql("buildings", "b")} = res.ref_u
+          GROUP BY res.i
+        ),
+        parcel AS (
+          SELECT res.i, MIN(b.reference) AS reference{geom_agg}, 'parcel' AS how
+          FROM res JOIN buildings b ON {ref14_sql("buildings", "b")} = res.ref_u AND length(res.ref_u) = 14
+          WHERE res.i NOT IN (SELECT i FROM exact)
+          GROUP BY res.i
+        ),
+        hit AS (SELECT * FROM exact UNION ALL SELECT * FROM parcel)
+        SELECT res.i, res.addr_ref, h.reference, h.how,
+               CASE WHEN m.reference IS NOT NULL THEN {metrics_json_sql("m")}::VARCHAR END,
+               CASE WHEN h.reference IS NOT NULL THEN {feature} END
+        FROM res
+        LEFT JOIN hit h USING (i)
+        LEFT JOIN edificios_metrics m ON {ref_upper_sql("edificios_metrics", "m")} = UPPER(h.reference)
+        QUALIFY row_number() OVER (PARTITION BY res.i ORDER BY m.reference) = 1
+        ORDER BY res.i;
+    """
+    batches = q_batches(con, sql, [[p[1] for p in parsed], [p[2] for p in parsed], [p[3] for p in parsed]])
+
+    def lines():
+        for rows in batches:
+            out = []
+            for i, addr_ref, ref, how, metrics_js, feature_js in rows:
+                rid, in_ref, street, _, err = parsed[i]
+                item = {"row": i, "id": rid}
+                if err:
+                    item.update(status="invalid", error=err)
+                elif ref is None:
+                    item.update(status="address_not_found" if street and addr_ref is None else "building_not_found",
+                                by="address" if street else "reference", reference=in_ref or addr_ref)
+                else:
+                    item.update(status="ok", by="address" if street else "reference", reference=ref, match=how)
+                line = json.dumps(item, ensure_ascii=False)
+                if ref is not None:
+                    # metrics y feature ya vienen como JSON de DuckDB: se pegan tal cual
+                    line = line[:-1] + ',"metrics":' + (metrics_js or "null")
+                    if include_feature:
+                        line += ',"feature":' + (feature_js or "null")
+                    line += "}"
+                out.append(line + "\n")
+            yield "".join(out)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 # ============================================================
 # CELS
 # ============================================================
@@ -607,7 +1705,8 @@ def cels_features(
     bbox: str | None = Query(None, description="minx,miny,maxx,maxy (WGS84)"),
     limit: int = 20000,
     offset: int = 0,
-    con: duckdb.DuckDBPyConnection = Depends(get_conn),   # <— same as your working API
+    cursor: str | None = Query(None, description="Cursor keyset ('' = primera página)"),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),   # <— same as your working API
 ):
     if not bbox:
         raise HTTPException(400, "bbox es obligatorio en /cels/features")
@@ -615,44 +1714,38 @@ def cels_features(
     limit = max(100, min(int(limit), 20000))
     offset = max(0, int(offset))
 
-    where, params = parse_bbox(bbox)
+    # se pagina sobre cels_points; LEFT JOIN para que la página no pierda filas
+    page, params, page_limit = paginate(
+        f"SELECT rowid AS _k, geom AS pt, id FROM {CELS_POINTS}", "cels_points", bbox, limit, offset, cursor)
+    props = """to_json(struct_pack(
+        id := id,
+        nombre := nombre,
+        street_norm := street_norm,
+        number_norm := number_norm,
+        reference := reference,
+        auto_CEL := auto_CEL,
+        por_ocupacion := por_ocupacion,
+        num_usuarios := num_usuarios
+    ))"""
     rows = q(con, f"""
-        WITH j AS (
+        WITH p AS (
+          {page}
+        ),
+        j AS (
           SELECT 
-            ST_PointOnSurface(b.geom) AS pt,
-            c.id, c.nombre, c.street_norm, c.number_norm, c.reference, c.auto_CEL,
+            p._k, p.pt,
+            p.id, c.nombre, c.street_norm, c.number_norm, c.reference, c.auto_CEL,
             CAST(c.por_ocupacion AS DOUBLE) AS por_ocupacion,
             COALESCE(c.num_usuarios, 0) AS num_usuarios
-          FROM buildings b
-          JOIN autoconsumos_CELS c
-            ON LEFT(UPPER(b.reference), 14) = LEFT(UPPER(c.reference), 14)
-          {where.replace("geom", "pt")}
-          LIMIT ? OFFSET ?
+          FROM p
+          LEFT JOIN autoconsumos_CELS c ON c.id = p.id
         )
-        SELECT ST_AsGeoJSON(pt), to_json(struct_pack(
-            id := id,
-            nombre := nombre,
-            street_norm := street_norm,
-            number_norm := number_norm,
-            reference := reference,
-            auto_CEL := auto_CEL,
-            por_ocupacion := por_ocupacion,
-            num_usuarios := num_usuarios
-        ))
-        FROM j;
-    """, params + [limit, offset])
+        SELECT {feature_sql("pt", props)}, _k
+        FROM j
+        ORDER BY _k;
+    """, params)
 
-    return {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": json.loads(gjson),
-                "properties": json.loads(props) if isinstance(props, str) else (props or {}),
-            }
-            for gjson, props in rows
-        ],
-    }
+    return fc_response(rows, page_limit)
 
 
 
@@ -660,34 +1753,31 @@ def cels_features(
 @app.post("/cels/within")
 def cels_within_buffer(
     req: CelsWithinReq,
-    radius_m: float = Query(500, description="Radio del buffer CELS en metros"),
+    radius_m: float = Query(500, ge=0, description="Radio del buffer CELS en metros"),
     con: duckdb.DuckDBPyConnection = Depends(get_conn),
 ):
     geojson_str = json.dumps(req.geometry)
-    # 1 degree lon ~ 85km near Madrid; rough conversion is fine for UI proximity
-    radius_deg = radius_m / 85000.0
+    # Centro en EPSG:25830 (metros); la búsqueda la resuelve el KD-tree
+    center = q(con, """
+        WITH c AS (
+          SELECT ST_Transform(ST_Centroid(ST_GeomFromGeoJSON(?::VARCHAR)), 'EPSG:4326', 'EPSG:25830', TRUE) AS p
+        )
+        SELECT ST_X(p), ST_Y(p) FROM c;
+    """, [geojson_str])
+    if not center or center[0][0] is None:
+        raise HTTPException(400, "Geometría no válida")
+
+    hits = CELS_INDEX.within(center[0][0], center[0][1], radius_m)
+    dist_by_id = {p.id: d for d, p in hits}
     rows = q(con, """
-        WITH input_geom AS (SELECT ST_GeomFromGeoJSON(?::VARCHAR) AS geom),
-        cels_points AS (
-        SELECT c.id, c.nombre, c.street_norm, c.number_norm, c.reference AS cels_ref, c.auto_CEL,
-                c.por_ocupacion,
-                ST_Centroid(b.geom) AS point_geom
-        FROM autoconsumos_CELS c
-        JOIN buildings b ON LEFT(UPPER(b.reference),14)=LEFT(UPPER(c.reference),14)
-        ),
-        input_point AS (SELECT ST_Centroid(geom) AS center FROM input_geom)
-        SELECT cp.id, cp.nombre, cp.street_norm, cp.number_norm, cp.cels_ref, cp.auto_CEL,
-            cp.por_ocupacion,
-            ST_Distance(cp.point_geom, ip.center) AS distance_deg
-        FROM cels_points cp, input_point ip
-        WHERE ST_Distance(cp.point_geom, ip.center) <= ?
-        ORDER BY distance_deg;
-    """, [geojson_str, radius_deg])
+        SELECT id, nombre, street_norm, number_norm, reference, auto_CEL, por_ocupacion
+        FROM autoconsumos_CELS
+        WHERE list_contains(?, id);
+    """, [list(dist_by_id)]) if dist_by_id else []
+    rows.sort(key=lambda r: dist_by_id[r[0]])
 
     cels = []
     for row in rows:
-        # indices: 0..6 datos, 7 distancia
-        dist_m = (float(row[7]) * 85000.0) if row[7] is not None else None
         por_oc = float(row[6]) if row[6] is not None else None
         cels.append({
             "id": row[0],
@@ -697,7 +1787,7 @@ def cels_within_buffer(
             "reference": row[4],
             "auto_CEL": int(row[5]) if row[5] is not None else None,
             "por_ocupacion": por_oc,             # ⬅️ devolverlo
-            "distance_m": dist_m,
+            "distance_m": dist_by_id[row[0]],
         })
     return {"count": len(cels), "cels": cels, "radius_m": radius_m}
 
@@ -706,12 +1796,7 @@ def cels_within_buffer(
 def debug_cels_count(con: duckdb.DuckDBPyConnection = Depends(get_conn)):
     try:
         count_cels = q(con, "SELECT COUNT(*) FROM autoconsumos_CELS")[0][0]
-        count_matches = q(con, """
-            SELECT COUNT(*)
-            FROM buildings b
-            JOIN autoconsumos_CELS c
-              ON LEFT(UPPER(b.reference), 14) = LEFT(UPPER(c.reference), 14)
-        """)[0][0]
+        count_matches = q(con, f"SELECT COUNT(*) FROM {CELS_POINTS}")[0][0]
         sample = q(con, """
             SELECT c.id, c.nombre, c.reference, c.auto_CEL
             FROM autoconsumos_CELS c
@@ -738,33 +1823,28 @@ def cadastre_by_refcat(
     ref_norm = refcat.strip()
 
     if not include_feature:
-        exists = q(con, "SELECT 1 FROM buildings WHERE UPPER(reference)=UPPER(?) LIMIT 1", [ref_norm])
+        exists = q(con, f"SELECT 1 FROM buildings WHERE {ref_upper_sql('buildings')} = UPPER(?) LIMIT 1", [ref_norm])
         if not exists:
             raise HTTPException(404, "Referencia catastral no encontrada")
         return {"reference": ref_norm}
 
-    rows = q(con, """
+    rows = q(con, f"""
         WITH f AS (
-          SELECT geom, * EXCLUDE (geom)
+          SELECT *
           FROM buildings
-          WHERE UPPER(reference)=UPPER(?)
+          WHERE {ref_upper_sql("buildings")} = UPPER(?)
           LIMIT 1
         )
-        SELECT ST_AsGeoJSON(geom), to_json(f) FROM f;
+        SELECT {feature_sql("geom", ALL_PROPS)} FROM f;
     """, [ref_norm])
 
     if not rows:
         raise HTTPException(404, "Referencia catastral no encontrada")
 
-    gjson, props = rows[0]
-    return {
-        "reference": ref_norm,
-        "feature": {
-            "type": "Feature",
-            "geometry": json.loads(gjson),
-            "properties": json.loads(props) if isinstance(props, str) else (props or {})
-        }
-    }
+    return Response(
+        '{"reference":' + json.dumps(ref_norm) + ',"feature":' + rows[0][0] + "}",
+        media_type="application/json",
+    )
 
 
 
@@ -809,6 +1889,15 @@ class CelsOut(CelsBase):
 
 
 
+def _cels_derived_columns() -> list[tuple[str, str]]:
+    """(column, expression of the reference ?) for the derived columns autoconsumos_CELS has."""
+    out = []
+    if "autoconsumos_CELS" in REF_UPPER_TABLES:
+        out.append(("ref_upper", "UPPER(?)"))
+    if "autoconsumos_CELS" in REF14_TABLES:
+        out.append(("ref14", "LEFT(UPPER(?), 14)"))
+    return out
+
 # ---------- CELS create (POST) ----------
 @app.post("/cels")
 def create_cels(req: CelsBase, con: duckdb.DuckDBPyConnection = Depends(get_conn_rw)):
@@ -816,15 +1905,18 @@ def create_cels(req: CelsBase, con: duckdb.DuckDBPyConnection = Depends(get_conn
         raise HTTPException(403, "La API está en modo read-only (READ_ONLY)")
     try:
         con.execute("BEGIN")
-        dup = q(con, "SELECT 1 FROM autoconsumos_CELS WHERE UPPER(reference) = UPPER(?) LIMIT 1;", [req.reference])
+        dup = q(con, f"SELECT 1 FROM autoconsumos_CELS WHERE {ref_upper_sql('autoconsumos_CELS')} = UPPER(?) LIMIT 1;",
+                [req.reference])
         if dup:
             raise HTTPException(409, "Ya existe un registro con esa referencia.")
         new_id = con.execute("SELECT COALESCE(MAX(id),0)+1 FROM autoconsumos_CELS").fetchone()[0]
+        derived = _cels_derived_columns()
         con.execute(
-            """
+            f"""
             INSERT INTO autoconsumos_CELS
-              (id, nombre, street_norm, number_norm, reference, auto_CEL, por_ocupacion, num_usuarios)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+              (id, nombre, street_norm, number_norm, reference, auto_CEL, por_ocupacion, num_usuarios
+               {"".join(f", {c}" for c, _ in derived)})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?{"".join(f", {e}" for _, e in derived)})
             """,
             [
                 int(new_id),
@@ -835,9 +1927,14 @@ def create_cels(req: CelsBase, con: duckdb.DuckDBPyConnection = Depends(get_conn
                 int(req.auto_CEL),
                 float(req.por_ocupacion) if req.por_ocupacion is not None else None,
                 int(req.num_usuarios) if req.num_usuarios is not None else None,
+                *(req.reference for _ in derived),
             ],
         )
+        refresh_cels_points(con, int(new_id), in_transaction=True)
         con.execute("COMMIT")
+        refresh_cels_points(con, int(new_id))
+        refresh_cels_index(con)
+        bump_data_version(*CELS_TABLES)
         return {"ok": True, "id": int(new_id)}
     except HTTPException:
         con.execute("ROLLBACK")
@@ -860,15 +1957,16 @@ def update_cels(cid: int, req: CelsBase, con: duckdb.DuckDBPyConnection = Depend
         if not cur:
             raise HTTPException(404, "CELS no encontrado")
         dup = q(con,
-                "SELECT 1 FROM autoconsumos_CELS WHERE UPPER(reference) = UPPER(?) AND id <> ? LIMIT 1;",
+                f"SELECT 1 FROM autoconsumos_CELS WHERE {ref_upper_sql('autoconsumos_CELS')} = UPPER(?) AND id <> ? LIMIT 1;",
                 [req.reference, cid])
         if dup:
             raise HTTPException(409, "Ya existe un registro con esa referencia.")
+        derived = _cels_derived_columns()
         con.execute(
-            """
+            f"""
             UPDATE autoconsumos_CELS
             SET nombre = ?, street_norm = ?, number_norm = ?, reference = ?, auto_CEL = ?,
-                por_ocupacion = ?, num_usuarios = ?
+                por_ocupacion = ?, num_usuarios = ?{"".join(f", {c} = {e}" for c, e in derived)}
             WHERE id = ?
             """,
             [
@@ -879,10 +1977,15 @@ def update_cels(cid: int, req: CelsBase, con: duckdb.DuckDBPyConnection = Depend
                 int(req.auto_CEL),
                 float(req.por_ocupacion) if req.por_ocupacion is not None else None,
                 int(req.num_usuarios) if req.num_usuarios is not None else None,
+                *(req.reference for _ in derived),
                 int(cid),
             ],
         )
+        refresh_cels_points(con, int(cid), in_transaction=True)
         con.execute("COMMIT")
+        refresh_cels_points(con, int(cid))
+        refresh_cels_index(con)
+        bump_data_version(*CELS_TABLES)
         return {"ok": True, "id": int(cid)}
     except HTTPException:
         con.execute("ROLLBACK")
@@ -906,7 +2009,11 @@ def delete_cel(cid: int, con: duckdb.DuckDBPyConnection = Depends(get_conn_rw)):
             raise HTTPException(404, f"No existe un CEL con id={cid}")
 
         con.execute("DELETE FROM autoconsumos_CELS WHERE id = ?", [cid])
+        refresh_cels_points(con, cid, in_transaction=True)
         con.execute("COMMIT")
+        refresh_cels_points(con, cid)
+        refresh_cels_index(con)
+        bump_data_version(*CELS_TABLES)
         return {"detail": f"CEL con id={cid} eliminado correctamente"}
     except HTTPException:
         raise
@@ -919,78 +2026,66 @@ def delete_cel(cid: int, con: duckdb.DuckDBPyConnection = Depends(get_conn_rw)):
 @app.get("/cels/building_context")
 def cels_building_context(
     ref: str = Query(..., description="Referencia catastral del edificio pulsado"),
-    radius_m: float = Query(500, description="Radio del buffer en metros"),
-    con: duckdb.DuckDBPyConnection = Depends(get_conn_ro),  # <-- Uses fixed read-only
+    radius_m: float = Query(500, ge=0, description="Radio del buffer en metros"),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn),
 ):
     """
     Get CELS and Autoconsumo context for a building.
-    Returns the nearest CEL and Autoconsumo within radius_m.
+    Returns the nearest CEL and Autoconsumo within radius_m (metric, EPSG:25830).
     """
-    
-    radius_deg = radius_m / 85000.0
 
-    # Check if building exists
-    found = q(con, "SELECT 1 FROM buildings WHERE UPPER(reference)=UPPER(?) LIMIT 1;", [ref])
-    if not found:
+    # Check if building exists (y su centroide en metros)
+    target = q(con, f"""
+        WITH b AS (
+          SELECT ST_Transform(ST_Centroid(geom), 'EPSG:4326', 'EPSG:25830', TRUE) AS c
+          FROM buildings
+          WHERE {ref_upper_sql("buildings")} = UPPER(?)
+          LIMIT 1
+        )
+        SELECT ST_X(c), ST_Y(c) FROM b;
+    """, [ref])
+    if not target:
         raise HTTPException(404, f"Edificio no encontrado: {ref}")
+    tx, ty = target[0]
 
     def get_context_for_type(auto_val: int):
         """
         Get nearest CELS (auto_val=1) or Autoconsumo (auto_val=2)
         """
         try:
-            rows = q(con, """
-                WITH target AS (
-                  SELECT ST_Centroid(geom) AS center
-                  FROM buildings
-                  WHERE UPPER(reference)=UPPER(?)
-                  LIMIT 1
-                ),
-                cels_points AS (
-                  SELECT
-                    c.id, c.nombre, c.reference AS cels_ref,
-                    c.auto_CEL, 
-                    CAST(c.por_ocupacion AS DOUBLE) AS por_ocupacion,
-                    COALESCE(c.num_usuarios, 0) AS num_usuarios,
-                    ST_Centroid(b.geom) AS point_geom
-                  FROM autoconsumos_CELS c
-                  JOIN buildings b
-                    ON LEFT(UPPER(b.reference),14)=LEFT(UPPER(c.reference),14)
-                  WHERE c.auto_CEL = ?
-                ),
-                near AS (
-                  SELECT cp.*,
-                         ST_Distance(cp.point_geom, t.center) AS d
-                  FROM cels_points cp, target t
-                  WHERE ST_Distance(cp.point_geom, t.center) <= ?
-                  ORDER BY d ASC
-                  LIMIT 1
-                ),
-                env AS (
-                  SELECT ST_Envelope(ST_Buffer(n.point_geom, ?)) AS e
-                  FROM near n
-                ),
-                candidates AS (
-                  SELECT b.geom
-                  FROM buildings b, env e
-                  WHERE ST_Intersects(b.geom, e.e)
-                ),
-                bcount AS (
-                  SELECT COUNT(*) AS cnt
-                  FROM candidates c, near n
-                  WHERE ST_Distance(ST_Centroid(c.geom), n.point_geom) <= ?
-                )
-                SELECT
-                  n.id, n.cels_ref, n.auto_CEL, n.por_ocupacion, n.num_usuarios, 
-                  n.d AS distance_deg,
-                  (SELECT cnt FROM bcount) AS buildings_in_buffer
-                FROM near n;
-            """, [ref, auto_val, radius_deg, radius_deg, radius_deg])
+            near = CELS_INDEX.nearest(tx, ty, k=1, max_dist=radius_m, auto_cel=auto_val)
+            if not near:
+                return None
+            dist_m, pt = near[0]
 
+            rows = q(con, """
+                SELECT id, reference, auto_CEL,
+                       CAST(por_ocupacion AS DOUBLE), COALESCE(num_usuarios, 0)
+                FROM autoconsumos_CELS
+                WHERE id = ?;
+            """, [pt.id])
             if not rows:
                 return None
 
-            cid, cref, autoCEL, por_oc, num_users, dist_deg, bcount = rows[0]
+            # Edificios cuyo centroide cae a <= radius_m del CEL. El R-tree solo
+            # sirve un ST_Intersects a solas: va en su subconsulta (OFFSET 0
+            # impide que DuckDB la funda con el filtro de distancia de fuera).
+            bcount = q(con, """
+                SELECT COUNT(*)
+                FROM (
+                  SELECT geom FROM buildings
+                  WHERE ST_Intersects(
+                          geom,
+                          ST_Transform(ST_MakeEnvelope(?, ?, ?, ?), 'EPSG:25830', 'EPSG:4326', TRUE))
+                  OFFSET 0
+                ) b
+                WHERE ST_Distance(
+                        ST_Transform(ST_Centroid(b.geom), 'EPSG:4326', 'EPSG:25830', TRUE),
+                        ST_Point(?, ?)) <= ?;
+            """, [pt.x - radius_m, pt.y - radius_m, pt.x + radius_m, pt.y + radius_m,
+                  pt.x, pt.y, radius_m])[0][0]
+
+            cid, cref, autoCEL, por_oc, num_users = rows[0]
             
             return {
                 "id": int(cid) if cid is not None else None,
@@ -998,7 +2093,7 @@ def cels_building_context(
                 "auto_CEL": int(autoCEL) if autoCEL is not None else None,
                 "por_ocupacion": float(por_oc) if por_oc is not None else None,
                 "num_usuarios": int(num_users) if num_users is not None else 0,
-                "distance_m": (float(dist_deg) * 85000.0) if dist_deg is not None else None,
+                "distance_m": dist_m,
                 "buildings_in_buffer": int(bcount) if bcount is not None else 0,
             }
         except Exception as e:
@@ -1014,13 +2109,14 @@ def cels_building_context(
 
 
 
+
 # ---------- CELS list (GET) ----------
 @app.get("/cels")
 def list_cels(
     search: str | None = Query(None, description="Busca en nombre, calle o referencia"),
     limit: int = Query(50, ge=1, le=500),
     offset: int = Query(0, ge=0),
-    con: duckdb.DuckDBPyConnection = Depends(get_conn_ro),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn),
 ):
     where = ""
     params: list = []
@@ -1073,30 +2169,139 @@ def parcels_features(
     bbox: str | None = Query(None, description="minx,miny,maxx,maxy (WGS84)"),
     limit: int = Query(5000000, ge=1, le=10000000000),
     offset: int = Query(0, ge=0),
-    con: duckdb.DuckDBPyConnection = Depends(get_conn_ro),
+    stream: bool = Query(False, description="Envía el FeatureCollection por lotes"),
+    cursor: str | None = Query(None, description="Cursor keyset ('' = primera página)"),
+    zoom: int | None = Query(None, ge=0, le=24, description="Zoom del mapa (elige el nivel de detalle)"),
+    tolerance: float | None = Query(None, ge=0, description="Tolerancia de simplificación en grados"),
+    fmt: str = Query("geojson", alias="format", pattern=FEATURE_FORMAT_RE, description=FEATURE_FORMAT_DOC),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
 ):
     # Si tus geom están en EPSG:4326 no transformes; si están en 25830, usa parse_bbox_for_srid
-    where, params = parse_bbox(bbox)
+    geom = lod_geom_column("parcels", zoom, tolerance)
+    page, params, page_limit = paginate(
+        f"SELECT rowid AS _k, {geom} AS lod_geom, id, nationalCadastralReference FROM parcels",
+        "parcels", bbox, limit, offset, cursor)
 
-    rows = q(con, f"""
+    sql = f"""
         WITH f AS (
-          SELECT geom, id, nationalCadastralReference
-          FROM parcels
-          {where}
-          LIMIT ? OFFSET ?
+          {page}
         )
-        SELECT ST_AsGeoJSON(geom), id, nationalCadastralReference FROM f;
-    """, params + [limit, offset])
+        SELECT {feature_select(
+            fmt,
+            "lod_geom",
+            {"id": "id", "nationalCadastralReference": "nationalCadastralReference"},
+        )}, _k
+        FROM f;
+    """
+    return features_response(con, sql, params, stream, page_limit, fmt)
+
 
-    feats = [{
-        "type": "Feature",
-        "geometry": (json.loads(gjson) if isinstance(gjson, str) else gjson),
-        "properties": {
-            "id": pid,
-            "nationalCadastralReference": ncr
-        }
-    } for gjson, pid, ncr in rows]
 
-    return fc(feats)
+# ============================================================
+# VECTOR TILES (MVT)
+# ============================================================
 
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+MVT_MAX_ZOOM = 22
+WEB_MERCATOR_HALF = 20037508.342789244  # semieje EPSG:3857 (m)
+
+# capa -> origen, geometría, SRID nativo, propiedades y zoom mínimo.
+# Sólo se envían las propiedades que usa el mapa.
+MVT_LAYERS: dict[str, dict] = {
+    "buildings": {
+        "from": "buildings b LEFT JOIN edificios_metrics m "
+                f"ON {ref_upper_sql('buildings', 'b')} = {ref_upper_sql('edificios_metrics', 'm')}",
+        "geom": "b.geom",
+        "srid": 4326,
+        "props": "b.reference AS reference, "
+                 "CAST(COALESCE(m.irr_mean_kWhm2_y, m.irr_average) AS DOUBLE) AS irr_building",
+        "minzoom": 13,
+    },
+    "parcels": {
+        "from": "parcels",
+        "geom": "geom",
+        "srid": 4326,
+        "props": "id, nationalCadastralReference AS reference",
+        "minzoom": 13,
+    },
+    "irradiance": {
+        "from": "irr_points",
+        "geom": "geom",
+        "srid": 25830,
+        "props": "CAST(value AS DOUBLE) AS value",
+        "minzoom": 15,
+    },
+    "shadows": {
+        "from": "{table}",  # se resuelve con _shadow_table_or_400
+        "geom": "geom",
+        "srid": 4326,
+        "props": "CAST(shadow_count AS DOUBLE) AS shadow_count",
+        "minzoom": 15,
+    },
+}
+
+def tile_bounds_3857(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Bounds (minx, miny, maxx, maxy) del tile z/x/y en EPSG:3857."""
+    size = 2 * WEB_MERCATOR_HALF / (1 << z)
+    minx = -WEB_MERCATOR_HALF + x * size
+    maxy = WEB_MERCATOR_HALF - y * size
+    return minx, maxy - size, minx + size, maxy
+
+def render_tile(con: duckdb.DuckDBPyConnection, layer: str, z: int, x: int, y: int,
+                table: str = "shadows") -> bytes:
+    """Construye el tile MVT de una capa. Devuelve b'' si el tile está vacío."""
+    cfg = MVT_LAYERS[layer]
+    if z < cfg["minzoom"]:
+        return b""
+
+    src = cfg["from"].format(table=_shadow_table_or_400(table)) if layer == "shadows" else cfg["from"]
+    geom, srid = cfg["geom"], cfg["srid"]
+    minx, miny, maxx, maxy = tile_bounds_3857(z, x, y)
+    # margen del buffer para que los símbolos no se corten en el borde del tile
+    pad = (maxx - minx) * MVT_BUFFER / MVT_EXTENT
 
+    rows = q(con, f"""
+        WITH tile AS (
+          SELECT ST_MakeEnvelope(?, ?, ?, ?) AS env
+        ),
+        f AS (
+          SELECT
+            ST_AsMVTGeom(
+              ST_Transform({geom}, 'EPSG:{srid}', 'EPSG:3857', TRUE),
+              ST_Extent(tile.env), {MVT_EXTENT}, {MVT_BUFFER}, TRUE
+            ) AS geometry,
+            {cfg["props"]}
+          FROM {src}, tile
+          -- envelope constante (no columna del CTE) para que aplique el R-tree
+          WHERE ST_Intersects(
+            {geom},
+            ST_Transform(ST_MakeEnvelope(?, ?, ?, ?), 'EPSG:3857', 'EPSG:{srid}', TRUE)
+          )
+        )
+        SELECT ST_AsMVT(f, ?, {MVT_EXTENT}, 'geometry')
+        FROM f
+        WHERE geometry IS NOT NULL;
+    """, [minx, miny, maxx, maxy,
+          minx - pad, miny - pad, maxx + pad, maxy + pad,
+          layer])
+    return bytes(rows[0][0]) if rows and rows[0][0] is not None else b""
+
+@app.get("/tiles/{layer}/{z}/{x}/{y}.mvt")
+def vector_tile(
+    layer: str,
+    z: int,
+    x: int,
+    y: int,
+    table: str = Query("shadows", description="Tabla de sombras (sólo capa 'shadows')"),
+    con: duckdb.DuckDBPyConnection = Depends(get_conn_heavy),
+):
+    if layer not in MVT_LAYERS:
+        raise HTTPException(404, f"Capa no disponible: {layer}")
+    if not 0 <= z <= MVT_MAX_ZOOM or not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        raise HTTPException(400, "Tile fuera de rango")
+
+    data = render_tile(con, layer, z, x, y, table=table)
+    if not data:
+        return Response(status_code=204)
+    return Response(content=data, media_type="application/vnd.mapbox-vector-tile")
@@ -0,0 +1,9 @@
+# bench — synthetic warehouse + in-process benchmark of every app.py endpoint
+#
+#   cd server/public_api
+#   python -m bench generate --scale 0.25 --out /tmp/bench.duckdb
+#   python -m bench run --db /tmp/bench.duckdb --save-baseline bench/baseline.json
+#   python -m bench run --db /tmp/bench.duckdb --baseline bench/baseline.json
+#
+# Con la misma escala y semilla el almacén generado es idéntico (sin random():
+# todo sale de hash()), así que dos ejecuciones son comparables.
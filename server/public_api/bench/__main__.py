@@ -0,0 +1,63 @@
+import argparse, json, os, sys
+
+# los módulos de la API (app, migrations…) se importan por nombre
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m bench", description="Benchmark de la API EMSV")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    g = sub.add_parser("generate", help="Genera un warehouse.duckdb sintético")
+    g.add_argument("--out", required=True)
+    g.add_argument("--scale", type=float, default=1.0, help="1.0 ≈ Getafe (12k edificios)")
+    g.add_argument("--no-migrate", action="store_true", help="No aplica migraciones (mide el esquema original)")
+
+    r = sub.add_parser("run", help="Lanza todos los endpoints contra un warehouse")
+    r.add_argument("--db", required=True)
+    r.add_argument("-n", type=int, default=50, help="Peticiones por endpoint y fase")
+    r.add_argument("--concurrency", type=int, default=8)
+    r.add_argument("--warmup", type=int, default=3)
+    r.add_argument("--seed", type=int, default=7)
+    r.add_argument("--only", nargs="*", help="Solo estos escenarios")
+    r.add_argument("--with-cache", action="store_true", help="Deja activa la caché de respuestas")
+    r.add_argument("--no-writes", action="store_true", help="Omite POST /points y el ciclo de CELS")
+    r.add_argument("--out", help="Guarda el informe JSON")
+    r.add_argument("--save-baseline", metavar="PATH", help="Guarda el informe como línea base")
+    r.add_argument("--baseline", metavar="PATH", help="Compara con una línea base; sale con 1 si hay regresión")
+    r.add_argument("--tolerance", type=float, default=0.2, help="Margen de regresión (0.2 = 20 %%)")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "generate":
+        from bench.warehouse import generate
+        counts = generate(args.out, args.scale, migrate=not args.no_migrate)
+        print(json.dumps(counts, indent=2))
+        return 0
+
+    from bench import runner
+    report = runner.run(args.db, n=args.n, concurrency=args.concurrency, warmup=args.warmup,
+                        seed=args.seed, only=args.only, with_cache=args.with_cache,
+                        writes=not args.no_writes)
+    eps = report["endpoints"]
+    peak = max((e["peak_rss_mb"] for e in eps.values()), default=0)
+    print(f"{len(eps)} endpoints en {report['meta']['seconds']} s, RSS pico {peak} MB")
+    if eps:
+        name = max(eps, key=lambda k: eps[k]["rss_delta_mb"])
+        print(f"Mayor crecimiento de RSS: {name} (+{eps[name]['rss_delta_mb']} MB)")
+    for path in (args.out, args.save_baseline):
+        if path:
+            runner.save(report, path)
+            print("Informe guardado en", path)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            regressions = runner.compare(report, json.load(fh), args.tolerance)
+        for line in regressions:
+            print("REGRESIÓN", line)
+        if regressions:
+            return 1
+        print("Sin regresiones frente a", args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+# bench/runner.py — runs every app.py endpoint in-process and reports latency
+#
+# Por endpoint: fase secuencial (latencias p50/p95/p99) y fase concurrente
+# (peticiones/s con `concurrency` en vuelo), bytes de respuesta y memoria: el
+# pico de RSS durante el escenario (muestreando /proc/self/statm) y cuánto
+# crece sobre el RSS con el que empezó. ru_maxrss no sirve: es el pico de toda
+# la vida del proceso y un escenario pesado lo deja fijo para los siguientes.
+# La caché de respuestas se desactiva por defecto: se mide el trabajo real.
+from __future__ import annotations
+import asyncio, json, math, os, platform, random, threading, time
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass
+class Scenario:
+    name: str
+    method: str
+    # rng -> (path, params, json body)
+    build: Callable[[random.Random], tuple[str, dict, dict | None]]
+    ok: tuple[int, ...] = (200,)
+    stateful: bool = False  # escrituras: solo en fase secuencial
+    pages: int = 1          # sigue next_cursor hasta este número de páginas
+
+
+@dataclass
+class Samples:
+    refs: list[str]
+    centers: list[tuple[float, float]]  # centroides de edificios (lon, lat)
+    streets: list[tuple[str, str]]
+    cels_ids: list[int]
+    extent: tuple[float, float, float, float]
+
+
+def _pct(sorted_ms: list[float], p: float) -> float:
+    if not sorted_ms:
+        return float("nan")
+    k = max(0, min(len(sorted_ms) - 1, math.ceil(p / 100 * len(sorted_ms)) - 1))
+    return sorted_ms[k]
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return float("nan")
+
+
+class RssSampler:
+    """Samples the RSS while a scenario runs: start, peak and growth in MB."""
+
+    def __init__(self, interval_s: float = 0.005):
+        self.interval_s = interval_s
+        self.start = self.peak = float("nan")
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval_s):
+            self.peak = max(self.peak, _rss_mb())
+
+    def __enter__(self) -> "RssSampler":
+        self.start = self.peak = _rss_mb()
+        if not math.isnan(self.start):  # sin /proc (macOS) no hay muestras
+            self._thread = threading.Thread(target=self._loop, name="bench-rss", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.peak = max(self.peak, _rss_mb())
+
+    def report(self) -> dict:
+        return {"rss_mb": round(_rss_mb(), 1), "peak_rss_mb": round(self.peak, 1),
+                "rss_delta_mb": round(self.peak - self.start, 1)}
+
+
+def load_samples(con, n: int = 200) -> Samples:
+    rows = con.execute(f"""
+        SELECT reference, ST_X(c), ST_Y(c) FROM (
+          SELECT reference, ST_Centroid(geom) AS c FROM buildings USING SAMPLE {n} ROWS (reservoir, 42)
+        );
+    """).fetchall()
+    ext = con.execute("""
+        SELECT MIN(ST_XMin(geom)), MIN(ST_YMin(geom)), MAX(ST_XMax(geom)), MAX(ST_YMax(geom)) FROM buildings;
+    """).fetchone()
+    streets = con.execute(
+        "SELECT street_norm, number_norm FROM address_index USING SAMPLE 100 ROWS (reservoir, 42);"
+    ).fetchall()
+    cels = [r[0] for r in con.execute("SELECT id FROM autoconsumos_CELS ORDER BY id LIMIT 100;").fetchall()]
+    return Samples([r[0] for r in rows], [(r[1], r[2]) for r in rows], streets, cels, tuple(ext))
+
+
+def _bbox(center: tuple[float, float], half_deg: float) -> str:
+    x, y = center
+    return f"{x - half_deg},{y - half_deg},{x + half_deg},{y + half_deg}"
+
+
+def _square(center: tuple[float, float], half_deg: float) -> dict:
+    x, y = center
+    return {"type": "Polygon", "coordinates": [[
+        [x - half_deg, y - half_deg], [x + half_deg, y - half_deg],
+        [x + half_deg, y + half_deg], [x - half_deg, y + half_deg], [x - half_deg, y - half_deg]]]}
+
+
+def _tile(lon: float, lat: float, z: int) -> tuple[int, int, int]:
+    n = 1 << z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return z, x, y
+
+
+def scenarios(s: Samples) -> list[Scenario]:
+    """One scenario per route (some routes get a small and a large variant)."""
+    c = lambda r: r.choice(s.centers)
+    ref = lambda r: r.choice(s.refs)
+    minx, miny, maxx, maxy = s.extent
+    city = f"{minx},{miny},{maxx},{maxy}"
+    street_view, block_view = 0.0015, 0.006  # medio lado del bbox en grados (~170 m, ~670 m)
+
+    def zones(r, k):
+        return {"type": "FeatureCollection",
+                "features": [{"type": "Feature", "id": i, "properties": {}, "geometry": _square(c(r), 0.001)}
+                             for i in range(k)],
+                "percentiles": [50, 90]}
+
+    return [
+        Scenario("health", "GET", lambda r: ("/api/visor_emsv", {}, None)),
+        Scenario("buffers", "GET", lambda r: ("/buffers", {"bbox": _bbox(c(r), block_view)}, None)),
+        Scenario("points_count", "GET", lambda r: ("/points/count", {"bbox": _bbox(c(r), block_view)}, None)),
+        Scenario("points_features", "GET", lambda r: ("/points/features", {"bbox": _bbox(c(r), block_view), "cursor": ""}, None)),
+        Scenario("shadows_features", "GET", lambda r: ("/shadows/features", {"bbox": _bbox(c(r), street_view), "cursor": ""}, None)),
+        Scenario("shadows_features_arrow", "GET", lambda r: ("/shadows/features", {"bbox": _bbox(c(r), block_view), "format": "arrow"}, None)),
+        Scenario("shadows_zonal", "POST", lambda r: ("/shadows/zonal", {}, {"geometry": _square(c(r), 0.004)})),
+        Scenario("shadows_zonal_batch", "POST", lambda r: ("/shadows/zonal/batch", {}, zones(r, 50))),
+        Scenario("shadows_aggregate", "GET", lambda r: ("/shadows/aggregate", {"bbox": city}, None)),
+        Scenario("irradiance_features", "GET", lambda r: ("/irradiance/features", {"bbox": _bbox(c(r), street_view), "cursor": ""}, None)),
+        Scenario("irradiance_features_pages", "GET", lambda r: ("/irradiance/features", {"bbox": _bbox(c(r), block_view), "cursor": "", "limit": 500}, None), pages=10),
+        Scenario("irradiance_features_stream", "GET", lambda r: ("/irradiance/features", {"bbox": _bbox(c(r), block_view), "stream": "true"}, None)),
+        Scenario("irradiance_zonal", "POST", lambda r: ("/irradiance/zonal", {}, {"geometry": _square(c(r), 0.004)})),
+        Scenario("irradiance_zonal_batch", "POST", lambda r: ("/irradiance/zonal/batch", {}, zones(r, 50))),
+        Scenario("irradiance_aggregate", "GET", lambda r: ("/irradiance/aggregate", {"bbox": city}, None)),
+        Scenario("buildings_features", "GET", lambda r: ("/buildings/features", {"bbox": _bbox(c(r), block_view)}, None)),
+        Scenario("buildings_features_city_lod", "GET", lambda r: ("/buildings/features", {"bbox": city, "zoom": 12}, None)),
+        Scenario("buildings_irradiance", "GET", lambda r: ("/buildings/irradiance", {"bbox": _bbox(c(r), block_view)}, None)),
+        Scenario("buildings_metrics", "GET", lambda r: ("/buildings/metrics", {"reference": ref(r)}, None), ok=(200, 404)),
+        Scenario("buildings_by_ref", "GET", lambda r: ("/buildings/by_ref", {"ref": ref(r).lower()}, None)),
+        Scenario("buildings_by_refs", "POST", lambda r: ("/buildings/by_refs", {}, {"references": r.sample(s.refs, min(len(s.refs), 200))})),
+        Scenario("address_lookup", "GET", lambda r: ("/address/lookup", dict(zip(("street", "number"), r.choice(s.streets)), include_feature="true"), None)),
+        Scenario("address_suggest", "GET", lambda r: ("/address/suggest", {"q": r.choice(s.streets)[0][:r.randint(3, 8)]}, None)),
+        Scenario("geocode_batch", "POST", lambda r: ("/geocode/batch", {}, [
+            {"id": k, "reference": ref(r).lower()} if k % 2 else
+            dict(zip(("street", "number"), r.choice(s.streets)), id=k) for k in range(1000)])),
+        Scenario("cels_features", "GET", lambda r: ("/cels/features", {"bbox": city}, None)),
+        Scenario("cels_within", "POST", lambda r: ("/cels/within", {"radius_m": 800}, {"geometry": _square(c(r), 0.0005)})),
+        Scenario("debug_cels_count", "GET", lambda r: ("/debug/cels/count", {}, None)),
+        Scenario("cadastre_feature", "GET", lambda r: ("/cadastre/feature", {"refcat": ref(r), "include_feature": "true"}, None)),
+        Scenario("cels_building_context", "GET", lambda r: ("/cels/building_context", {"ref": ref(r), "radius_m": 500}, None)),
+        Scenario("cels_list", "GET", lambda r: ("/cels", {"search": r.choice(["CEL", "MADRID", "1"])}, None)),
+        Scenario("parcels_features", "GET", lambda r: ("/parcels/features", {"bbox": _bbox(c(r), block_view), "cursor": ""}, None)),
+        Scenario("parcels_features_pages", "GET", lambda r: ("/parcels/features", {"bbox": _bbox(c(r), block_view), "cursor": "", "limit": 200}, None), pages=10),
+        Scenario("parcels_features_fgb", "GET", lambda r: ("/parcels/features", {"bbox": _bbox(c(r), block_view), "format": "fgb"}, None)),
+        Scenario("tiles_buildings_z16", "GET", lambda r: ("/tiles/buildings/%d/%d/%d.mvt" % _tile(*c(r), 16), {}, None), ok=(200, 204)),
+        Scenario("tiles_irradiance_z17", "GET", lambda r: ("/tiles/irradiance/%d/%d/%d.mvt" % _tile(*c(r), 17), {}, None), ok=(200, 204)),
+        Scenario("metrics", "GET", lambda r: ("/metrics", {}, None)),
+    ]
+
+
+def write_scenarios(s: Samples) -> tuple[list[Scenario], dict]:
+    """POST /points and the CELS create -> update -> delete cycle (net zero CELS)."""
+    state: dict = {}
+    c = lambda r: r.choice(s.centers)
+
+    def cels_body(r):
+        street, number = r.choice(s.streets)
+        return {"nombre": "bench", "street_norm": street, "number_norm": int(number),
+                "reference": r.choice(s.refs), "auto_CEL": 1, "por_ocupacion": 50}
+
+    def create(r):
+        return "/cels", {}, cels_body(r)
+
+    def update(r):
+        return f"/cels/{state.get('cid', 0)}", {}, cels_body(r)
+
+    def delete(r):
+        return f"/cels/{state.pop('cid', 0)}", {}, None
+
+    return [
+        Scenario("save_point", "POST", lambda r: ("/points", {}, dict(zip(("lon", "lat"), c(r)), user_id="bench")), stateful=True),
+        Scenario("create_cels", "POST", create, stateful=True),
+        Scenario("update_cels", "PUT", update, stateful=True),
+        Scenario("delete_cel", "DELETE", delete, stateful=True),
+    ], state
+
+
+def _next_cursor(r) -> str | None:
+    """next_cursor of a keyset page: X-Next-Cursor header (arrow) or the end of the GeoJSON."""
+    if "x-next-cursor" in r.headers:
+        return r.headers["x-next-cursor"] or None
+    body = r.content.rstrip()
+    i = body.rfind(b'"next_cursor":')
+    return json.loads(body[i + len(b'"next_cursor":'):-1]) if i >= 0 else None
+
+
+async def _one(client, sc: Scenario, rng: random.Random) -> tuple[float, int, int, object]:
+    """One request, or a walk of up to sc.pages pages; time and bytes cover the whole walk."""
+    path, params, body = sc.build(rng)
+    t0 = time.perf_counter()
+    r = await client.request(sc.method, path, params=params, json=body)
+    await r.aread()
+    nbytes = len(r.content)
+    for _ in range(sc.pages - 1):
+        cur = _next_cursor(r) if r.status_code == 200 else None
+        if not cur:
+            break
+        r = await client.request(sc.method, path, params={**params, "cursor": cur}, json=body)
+        await r.aread()
+        nbytes += len(r.content)
+    return (time.perf_counter() - t0) * 1000, r.status_code, nbytes, r
+
+
+async def _measure(client, sc: Scenario, n: int, concurrency: int, warmup: int, seed: int) -> dict:
+    with RssSampler() as rss:
+        res = await _measure_phases(client, sc, n, concurrency, warmup, seed)
+    res.update(rss.report())
+    return res
+
+
+async def _measure_phases(client, sc: Scenario, n: int, concurrency: int, warmup: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    for _ in range(warmup):
+        await _one(client, sc, rng)
+    lat, errors, nbytes = [], 0, 0
+    for _ in range(n):
+        ms, status, size, _ = await _one(client, sc, rng)
+        lat.append(ms)
+        nbytes += size
+        errors += status not in sc.ok
+    lat.sort()
+    res = {
+        "n": n, "errors": errors,
+        "p50_ms": round(_pct(lat, 50), 2), "p95_ms": round(_pct(lat, 95), 2),
+        "p99_ms": round(_pct(lat, 99), 2), "mean_ms": round(sum(lat) / len(lat), 2),
+        "avg_bytes": int(nbytes / n),
+    }
+    if concurrency > 1:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def limited(i):
+            async with sem:
+                return await _one(client, sc, random.Random(seed * 1000 + i))
+
+        t0 = time.perf_counter()
+        done = await asyncio.gather(*(limited(i) for i in range(n)))
+        wall = time.perf_counter() - t0
+        res["rps"] = round(n / wall, 1)
+        res["errors"] += sum(status not in sc.ok for _, status, _, _ in done)
+    return res
+
+
+def run(db: str, n: int = 50, concurrency: int = 8, warmup: int = 3, seed: int = 7,
+        only: list[str] | None = None, with_cache: bool = False, writes: bool = True) -> dict:
+    """Benchmarks every scenario against the warehouse at `db`; returns the report dict."""
+    os.environ["DUCKDB_PATH"] = os.path.abspath(db)
+    os.environ["READ_ONLY"] = "false" if writes else "true"
+    os.environ.setdefault("SLOW_QUERY_MS", "0")
+    if not with_cache:
+        os.environ["RESPONSE_CACHE_MB"] = "0"
+    os.environ.setdefault("DUCKDB_HEAVY_QUEUE", str(max(8, concurrency * 2)))
+    import duckdb, httpx
+    import app as api  # importa la app con el entorno de arriba (pool, migraciones…)
+
+    samples = load_samples(api.DB_RW)
+    plan = scenarios(samples)
+    state = None
+    if writes:
+        wplan, state = write_scenarios(samples)
+        plan += wplan
+    if only:
+        plan = [sc for sc in plan if sc.name in only]
+
+    async def main():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=600) as client:
+            results = {}
+            for i, sc in enumerate(plan):
+                if sc.stateful:
+                    r = await _measure_writes(client, sc, n, seed + i, state)
+                else:
+                    r = await _measure(client, sc, n, concurrency, warmup, seed + i)
+                results[sc.name] = r
+                print(f"  {sc.name:<30} p50 {r['p50_ms']:>9.2f} ms  p95 {r['p95_ms']:>9.2f} ms  "
+                      f"p99 {r['p99_ms']:>9.2f} ms  {r.get('rps', float('nan')):>8.1f} req/s  "
+                      f"err {r['errors']}  rss +{r['rss_delta_mb']} MB (pico {r['peak_rss_mb']})", flush=True)
+            return results
+
+    t0 = time.time()
+    results = asyncio.run(main())
+    return {
+        "meta": {
+            "db": os.path.abspath(db),
+            "db_mb": round(os.path.getsize(db) / 2**20, 1),
+            "n": n, "concurrency": concurrency, "seed": seed, "with_cache": with_cache,
+            "python": platform.python_version(), "duckdb": duckdb.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t0)),
+            "seconds": round(time.time() - t0, 1),
+        },
+        "endpoints": results,
+    }
+
+
+async def _measure_writes(client, sc: Scenario, n: int, seed: int, state: dict) -> dict:
+    """Sequential only; create_cels leaves its id for update_cels / delete_cel."""
+    rng = random.Random(seed)
+    lat, errors = [], 0
+    reps = n if sc.name == "save_point" else 1
+    with RssSampler() as rss:
+        for _ in range(reps):
+            ms, status, _, resp = await _one(client, sc, rng)
+            lat.append(ms)
+            errors += status not in sc.ok
+            if sc.name == "create_cels" and status == 200:
+                state["cid"] = resp.json().get("id")
+    lat.sort()
+    return {"n": reps, "errors": errors, "p50_ms": round(_pct(lat, 50), 2),
+            "p95_ms": round(_pct(lat, 95), 2), "p99_ms": round(_pct(lat, 99), 2),
+            "mean_ms": round(sum(lat) / len(lat), 2), **rss.report()}
+
+
+def compare(report: dict, baseline: dict, tolerance: float = 0.2) -> list[str]:
+    """Regressions: p95 over baseline·(1+tolerance) or throughput under baseline·(1-tolerance)."""
+    out = []
+    for name, cur in report["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(name)
+        if not base:
+            continue
+        if base.get("p95_ms") and cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            out.append(f"{name}: p95 {cur['p95_ms']} ms > {base['p95_ms']} ms")
+        if base.get("rps") and cur.get("rps") and cur["rps"] < base["rps"] * (1 - tolerance):
+            out.append(f"{name}: {cur['rps']} req/s < {base['rps']} req/s")
+        if cur["errors"] > base.get("errors", 0):
+            out.append(f"{name}: {cur['errors']} errores (antes {base.get('errors', 0)})")
+    return out
+
+
+def save(report: dict, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump(report, fh, indent=2, ensure_ascii=False)
+        fh.write("\n")
@@ -0,0 +1,159 @@
+# bench/warehouse.py — synthetic Getafe-like warehouse.duckdb
+#
+# Escala 1 ≈ Getafe: ~12k edificios en manzanas de 6×6 parcelas, irradiancia
+# en malla de 2 m sobre cada cubierta (~1,7 M puntos), 400k puntos de sombra,
+# métricas para el 90 % de los edificios, índice de direcciones y ~200 CELS.
+# Los esquemas son los que lee app.py; después se aplican las migraciones
+# (índices, orden de Hilbert, pirámides, LOD) igual que en producción.
+from __future__ import annotations
+import math, os
+
+import duckdb
+
+import migrations
+
+# Centro de Getafe (EPSG:4326)
+CENTER_LON, CENTER_LAT = -3.7320, 40.3050
+SPACING_M = 55.0   # paso entre edificios dentro de una manzana
+STREET_M = 20.0    # calle cada 6 edificios
+IRR_STEP_M = 2.0   # malla de irradiancia sobre cubierta
+
+STREETS = ["MADRID", "TOLEDO", "LEGANES", "FUENLABRADA", "PARLA", "PINTO", "ALCORCON",
+           "GENERAL PINGARRON", "JUAN DE LA CIERVA", "FILIPINAS", "ARBOLEDA", "RIO TAJO",
+           "RIO JARAMA", "GUADALQUIVIR", "EBRO", "DUERO", "MIÑO", "JUAN DE BORBON",
+           "ISABEL LA CATOLICA", "FERNANDO III", "ALONSO DE MENDOZA", "DOCTOR MARTIN VEGUE",
+           "HOSPITAL DE SAN JOSE", "SAN EUGENIO", "MAGDALENA", "MANZANA", "PERAL", "OLIVO"]
+
+def _u(key: str) -> str:
+    """Uniform [0, 1) from hash(i, key): deterministic, unlike random()."""
+    return f"((hash(i, '{key}') % 1000000) / 1000000.0)"
+
+def generate(path: str, scale: float = 1.0, migrate: bool = True) -> dict:
+    """Writes the warehouse at `path` (overwrites it) and returns row counts per table."""
+    if os.path.exists(path):
+        os.remove(path)
+    n_b = max(100, int(12_000 * scale))
+    n_shadows = max(1_000, int(400_000 * scale))
+    n_npp = max(500, int(100_000 * scale))
+    n_cels = max(20, int(200 * scale))
+    n_big = max(100, int(5_000 * scale))
+    cols = math.ceil(math.sqrt(n_b))
+    half = cols * SPACING_M / 2 + (cols // 6) * STREET_M / 2
+
+    con = duckdb.connect(path)
+    con.execute("INSTALL spatial; LOAD spatial;")
+    ox, oy = con.execute(f"""
+        SELECT ST_X(p), ST_Y(p) FROM (
+          SELECT ST_Transform(ST_Point({CENTER_LON}, {CENTER_LAT}), 'EPSG:4326', 'EPSG:25830', TRUE) AS p);
+    """).fetchone()
+    to4326 = "'EPSG:25830', 'EPSG:4326', TRUE"
+    streets = "[" + ", ".join(f"'{s}'" for s in STREETS) + "]"
+
+    # huellas en metros (tabla auxiliar, se borra al final)
+    con.execute(f"""
+        CREATE TEMP TABLE bld AS
+        SELECT i, cx, cy,
+               {ox} + (cx - {cols} / 2) * {SPACING_M} + (cx // 6) * {STREET_M} + {_u('jx')} * 8 AS x0,
+               {oy} + (cy - {cols} / 2) * {SPACING_M} + (cy // 6) * {STREET_M} + {_u('jy')} * 8 AS y0,
+               10 + {_u('w')} * 30 AS w,
+               10 + {_u('h')} * 25 AS h,
+               printf('%07dVK%05d', i, (cx * 37 + cy) % 100000) AS ref14
+        FROM (SELECT i, i % {cols} AS cx, i // {cols} AS cy FROM range({n_b}) t(i));
+        ALTER TABLE bld ADD COLUMN reference VARCHAR;
+        UPDATE bld SET reference = ref14 || 'S0001' || chr(65 + CAST(i % 26 AS INTEGER))
+                                 || chr(65 + CAST((i // 26) % 26 AS INTEGER));
+    """)
+    con.execute(f"""
+        CREATE TABLE buildings AS
+        SELECT reference,
+               CASE WHEN {_u('use')} < 0.7 THEN '1_residential'
+                    WHEN {_u('use')} < 0.85 THEN '4_retail' ELSE '3_industrial' END AS currentUse,
+               1 + CAST({_u('fl')} * 8 AS INTEGER) AS numberOfFloorsAboveGround,
+               1950 + CAST({_u('yr')} * 70 AS INTEGER) AS beginning,
+               ST_Transform(ST_MakeEnvelope(x0, y0, x0 + w, y0 + h), {to4326}) AS geom
+        FROM bld ORDER BY i;
+    """)
+    con.execute(f"""
+        CREATE TABLE parcels AS
+        SELECT i + 1 AS id, ref14 AS nationalCadastralReference,
+               ST_Transform(ST_MakeEnvelope(x0 - 4, y0 - 4, x0 + w + 4, y0 + h + 4), {to4326}) AS geom
+        FROM bld ORDER BY i;
+    """)
+    con.execute(f"""
+        CREATE TABLE edificios_metrics AS
+        SELECT reference, irr AS irr_average, area AS area_m2, area * 0.6 AS superficie_util_m2,
+               area * 0.6 * 0.2 AS pot_kWp, area * 0.6 * 0.2 * irr * 0.8 AS energy_total_kWh,
+               100 * irr * 0.8 / 8760 AS factor_capacidad_pct, irr * 1.02 AS irr_mean_kWhm2_y
+        FROM (
+          SELECT i, reference, w * h AS area, 1000 + {_u('irr')} * 700 AS irr, {_u('has_m')} AS has_m FROM bld
+        )
+        WHERE has_m < 0.9
+        ORDER BY i;
+    """)
+    # malla de 2 m sobre cada cubierta, en EPSG:25830 como la tabla real
+    con.execute(f"""
+        CREATE TABLE irr_points AS
+        SELECT ST_Point(x0 + {IRR_STEP_M / 2} + gx * {IRR_STEP_M}, y0 + {IRR_STEP_M / 2} + gy * {IRR_STEP_M}) AS geom,
+               CAST(900 + ((hash(i, gx, gy) % 900000) / 1000.0) AS DOUBLE) AS value
+        FROM (
+          SELECT i, x0, y0, gx, unnest(range(CAST(floor(h / {IRR_STEP_M}) AS BIGINT))) AS gy
+          FROM (SELECT i, x0, y0, h, unnest(range(CAST(floor(w / {IRR_STEP_M}) AS BIGINT))) AS gx FROM bld)
+        );
+    """)
+    for table, n in (("shadows", n_shadows), ("puntos_no_parcelas", n_npp)):
+        con.execute(f"""
+            CREATE TABLE {table} AS
+            SELECT ST_Transform(ST_Point({ox} + ({_u(table + 'x')} - 0.5) * {2 * half},
+                                         {oy} + ({_u(table + 'y')} - 0.5) * {2 * half}), {to4326}) AS geom,
+                   CAST(hash(i, '{table}c') % 366 AS INTEGER) AS shadow_count
+            FROM range({n}) t(i);
+        """)
+    con.execute(f"""
+        CREATE TABLE address_index AS
+        SELECT {streets}[CAST(cy % {len(STREETS)} AS INTEGER) + 1]
+                 || CASE WHEN cy >= {len(STREETS)} THEN ' ' || (cy // {len(STREETS)}) ELSE '' END AS street_norm,
+               CAST(cx + 1 AS VARCHAR) AS number_norm,
+               reference
+        FROM bld ORDER BY i;
+    """)
+    con.execute(f"""
+        CREATE TABLE autoconsumos_CELS AS
+        SELECT CAST(j + 1 AS INTEGER) AS id,
+               CASE WHEN j % 3 = 0 THEN 'Autoconsumo ' ELSE 'CEL ' END || (j + 1) AS nombre,
+               a.street_norm, CAST(a.number_norm AS INTEGER) AS number_norm, a.reference,
+               CASE WHEN j % 3 = 0 THEN 2 ELSE 1 END AS auto_CEL,
+               CAST((hash(j, 'oc') % 100) AS DOUBLE) AS por_ocupacion,
+               CASE WHEN j % 3 = 0 THEN CAST(2 + hash(j, 'nu') % 40 AS INTEGER) END AS num_usuarios
+        FROM range({n_cels}) t(j)
+        JOIN (SELECT i AS k, street_norm, CAST(cx + 1 AS VARCHAR) AS number_norm, reference FROM address_index
+              JOIN bld USING (reference)) a
+          ON a.k = (j * 7919) % {n_b}
+        ORDER BY j;
+    """)
+    con.execute(f"""
+        CREATE TABLE big_points AS
+        SELECT CAST(i + 1 AS INTEGER) AS id, 'punto ' || (i + 1) AS name,
+               ST_Transform(ST_Point({ox} + ({_u('bpx')} - 0.5) * {2 * half},
+                                     {oy} + ({_u('bpy')} - 0.5) * {2 * half}), {to4326}) AS geom
+        FROM range({n_big}) t(i);
+    """)
+    con.execute("""
+        CREATE TABLE points (id INTEGER, user_id VARCHAR, geom GEOMETRY, buffer_m DOUBLE, props JSON);
+    """)
+    con.execute(f"""
+        CREATE TABLE point_buffers AS
+        SELECT id, 'bench' AS user_id, 100.0 AS buffer_m,
+               ST_Transform(ST_Buffer(ST_Transform(geom, 'EPSG:4326', 'EPSG:25830', TRUE), 100), {to4326}) AS geom
+        FROM big_points WHERE id <= 200;
+    """)
+    con.execute("DROP TABLE bld;")
+
+    if migrate:
+        migrations.apply_migrations(con)
+        migrations.refresh_cels_points(con)
+    counts = {t: con.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+              for t in ("buildings", "parcels", "irr_points", "shadows", "puntos_no_parcelas",
+                        "edificios_metrics", "address_index", "autoconsumos_CELS", "big_points")}
+    con.execute("CHECKPOINT;")
+    con.close()
+    return counts
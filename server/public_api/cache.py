@@ -0,0 +1,197 @@
+# cache.py — versioned response cache (LRU) with ETag / 304 as ASGI middleware
+#
+# Cada tabla tiene un contador de versión que suben las escrituras. Una
+# respuesta GET depende de (ruta, query normalizada, codificación negociada,
+# versión de sus tablas): mientras no cambien, el cuerpo es el mismo, así que
+# el ETag sale de esa clave y un If-None-Match se contesta con 304 sin
+# ejecutar el endpoint. Se guardan los bytes ya comprimidos (el middleware
+# va por fuera de compression.py), una repetición no recomprime.
+# Peticiones idénticas simultáneas (single-flight) esperan a la primera y
+# reciben su misma respuesta, aunque no quepa en la caché.
+from __future__ import annotations
+import asyncio, hashlib, threading, time
+from collections import OrderedDict
+from typing import Iterable
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.datastructures import Headers, MutableHeaders
+
+import compression
+
+
+class DataVersions:
+    """Per-table write counters; the boot stamp makes ETags change across restarts."""
+
+    def __init__(self):
+        self.boot = f"{time.time():.0f}"
+        self._v: dict[str, int] = {}
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def bump(self, *tables: str) -> None:
+        with self._lock:
+            for t in tables:
+                self._v[t.lower()] = self._v.get(t.lower(), 0) + 1
+            self._total += 1
+
+    def token(self, tables: Iterable[str] | None = None) -> str:
+        """Version of a set of tables (None = any table)."""
+        with self._lock:
+            if tables is None:
+                return f"{self.boot}.{self._total}"
+            return self.boot + "." + ".".join(str(self._v.get(t.lower(), 0)) for t in tables)
+
+
+class BytesLRU:
+    """Thread-safe LRU bounded by total stored bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = 0
+        self.coalesced = 0  # peticiones servidas por single-flight (ni hit ni miss)
+        self._d: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def get(self, key):
+        with self._lock:
+            item = self._d.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._d.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, nbytes: int) -> None:
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._d.pop(key, None)
+            if old is not None:
+                self.size -= old[0]
+            self._d[key] = (nbytes, value)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, (n, _) = self._d.popitem(last=False)
+                self.size -= n
+
+    def clear(self) -> None:
+        with self._lock:
+            self._d.clear()
+            self.size = 0
+
+
+def normalize_query(query_string: bytes) -> str:
+    """Query string with parameters sorted, so ?a=1&b=2 and ?b=2&a=1 share an entry."""
+    pairs = parse_qsl(query_string.decode("latin-1"), keep_blank_values=True)
+    return urlencode(sorted(pairs))
+
+
+class ResponseCacheMiddleware:
+    """
+    ETag / If-None-Match and an LRU of complete GET 200 responses.
+
+    route_tables maps a path prefix to the tables its responses depend on;
+    paths with no prefix match depend on every table. Paths in `skip` are
+    never cached nor tagged (health checks, metrics…). Streamed responses get
+    an ETag but are not stored nor shared.
+    """
+
+    def __init__(self, app, versions: DataVersions, route_tables: dict[str, tuple[str, ...]],
+                 max_bytes: int = 256 * 1024 * 1024, max_entry_bytes: int = 32 * 1024 * 1024,
+                 skip: tuple[str, ...] = (), store: BytesLRU | None = None):
+        self.app = app
+        self.versions = versions
+        # prefijo más largo primero
+        self.route_tables = sorted(route_tables.items(), key=lambda kv: -len(kv[0]))
+        self.max_entry_bytes = max_entry_bytes
+        self.skip = skip
+        self.store = store if store is not None else BytesLRU(max_bytes)
+        # clave -> Future con (status, headers, body) de la petición en curso, o None si no se comparte
+        self._inflight: dict[tuple, asyncio.Future] = {}
+
+    def tables_for(self, path: str) -> tuple[str, ...] | None:
+        for prefix, tables in self.route_tables:
+            if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+                return tables
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] != "GET"
+                or scope["path"].startswith(self.skip)):
+            return await self.app(scope, receive, send)
+
+        req = Headers(scope=scope)
+        path, query = scope["path"], normalize_query(scope["query_string"])
+        token = self.versions.token(self.tables_for(path))
+        digest = hashlib.sha1(f"{path}?{query}|{token}".encode()).hexdigest()[:24]
+        # débil: la misma representación puede ir con distintas codificaciones
+        etag = f'W/"{digest}"'
+
+        inm = req.get("if-none-match", "")
+        if inm and (inm.strip() == "*" or etag in (t.strip() for t in inm.split(","))):
+            await send({"type": "http.response.start", "status": 304,
+                        "headers": [(b"etag", etag.encode()), (b"vary", b"Accept-Encoding")]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        encoding = compression.negotiate(req.get("accept-encoding", "")) or "identity"
+        key = (path, query, encoding, token)
+        hit = None
+        if key in self._inflight:
+            # single-flight: misma petición ya en curso, se espera su resultado
+            # (mientras está en curso no puede estar en la caché)
+            hit = await asyncio.shield(self._inflight[key])
+            if hit is not None:
+                self.store.coalesced += 1
+        if hit is None:
+            hit = self.store.get(key)
+        if hit is not None:
+            status, headers, body = hit
+            await send({"type": "http.response.start", "status": status, "headers": list(headers)})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        flight = self._inflight[key] = asyncio.get_running_loop().create_future()
+        start = None
+        chunks: list[bytes] | None = []
+
+        def share(result) -> None:
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+            if not flight.done():
+                flight.set_result(result)
+
+        async def wrapped_send(message):
+            nonlocal start, chunks
+            if message["type"] == "http.response.start":
+                if message["status"] != 200:
+                    chunks = None
+                    share(None)
+                else:
+                    headers = MutableHeaders(raw=message["headers"])
+                    headers["etag"] = etag
+                    if "cache-control" not in headers:
+                        headers["cache-control"] = "no-cache"  # el navegador revalida con If-None-Match
+                start = message
+            elif message["type"] == "http.response.body" and chunks is not None:
+                chunks.append(message.get("body", b""))
+                if message.get("more_body", False):
+                    chunks = None  # streaming: ni se guarda ni se comparte
+                    share(None)
+                else:
+                    body = b"".join(chunks)
+                    result = (200, list(start["headers"]), body)
+                    if len(body) <= self.max_entry_bytes:
+                        self.store.put(key, result, len(body))
+                    share(result)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            share(None)
@@ -0,0 +1,149 @@
+# compression.py — Accept-Encoding negotiation (zstd / br / gzip) as ASGI middleware
+#
+# Respuestas completas: se comprimen de una vez (y cache.py guarda el
+# resultado ya comprimido). Respuestas en streaming: se comprimen lote a lote.
+from __future__ import annotations
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:  # opcionales: sin ellos solo se negocia gzip
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Preferencia del servidor cuando el cliente acepta varias con el mismo q
+ENCODINGS = tuple(e for e, ok in (("zstd", zstandard is not None),
+                                  ("br", brotli is not None),
+                                  ("gzip", True)) if ok)
+
+COMPRESSIBLE_TYPES = (
+    "application/json", "application/geo+json",
+    "application/vnd.apache.arrow.stream", "application/flatgeobuf",
+    "application/vnd.mapbox-vector-tile", "text/",
+)
+
+
+def negotiate(accept_encoding: str) -> str | None:
+    """Best encoding we support for an Accept-Encoding header (None = identity)."""
+    accepted: dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        qv = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                qv = float(params[2:])
+            except ValueError:
+                qv = 0.0
+        if name:
+            accepted[name.strip().lower()] = qv
+    best, best_q = None, 0.0
+    for enc in ENCODINGS:
+        qv = accepted.get(enc, accepted.get("*", 0.0))
+        if qv > best_q:
+            best, best_q = enc, qv
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """One-shot compression (whole responses, which may end up cached)."""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    if encoding == "br":
+        return brotli.compress(data, quality=7)
+    co = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = cabecera gzip
+    return co.compress(data) + co.flush()
+
+
+class StreamCompressor:
+    """Incremental compressor; every chunk is flushed so the client can decode it."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._c = zstandard.ZstdCompressor(level=3).compressobj()
+        elif encoding == "br":
+            self._c = brotli.Compressor(quality=4)
+        else:
+            self._c = zlib.compressobj(5, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        if self.encoding == "zstd":
+            return self._c.compress(data) + self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == "br":
+            return self._c.process(data) + self._c.flush()
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "zstd":
+            return self._c.flush()
+        if self.encoding == "br":
+            return self._c.finish()
+        return self._c.flush()
+
+
+class CompressionMiddleware:
+    """Negotiated gzip / br / zstd for compressible responses of at least `minimum_size` bytes."""
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        stream: StreamCompressor | None = None
+        passthrough = False
+
+        async def wrapped_send(message):
+            nonlocal start, stream, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                headers = Headers(raw=message["headers"])
+                ctype = headers.get("content-type", "")
+                passthrough = ("content-encoding" in headers
+                               or not ctype.startswith(COMPRESSIBLE_TYPES))
+                if passthrough:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                return await send(message)
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if stream is None and start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                if not more:
+                    # respuesta completa: de una vez
+                    if len(body) < self.minimum_size:
+                        await send(start)
+                        return await send(message)
+                    data = compress(body, encoding)
+                    headers["content-encoding"] = encoding
+                    headers["content-length"] = str(len(data))
+                    headers.add_vary_header("Accept-Encoding")
+                    await send(start)
+                    return await send({"type": "http.response.body", "body": data})
+                # streaming: se comprime lote a lote
+                del headers["content-length"]
+                headers["content-encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                stream = StreamCompressor(encoding)
+                await send(start)
+                start = None
+            data = stream.chunk(body) if body else b""
+            if not more:
+                data += stream.finish()
+            await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, wrapped_send)
@@ -0,0 +1,168 @@
+# metrics.py — in-process metrics in Prometheus text format (sin dependencias)
+#
+# MetricsMiddleware mide cada petición (ruta = plantilla de la ruta FastAPI,
+# no la URL, para no disparar la cardinalidad) y q() / get_conn() anotan en el
+# RequestStats de la petición en curso el tiempo de DuckDB, las filas y la
+# espera por el pool. "serialization" es el resto: Python, JSON y framework.
+from __future__ import annotations
+import contextvars, threading, time
+from typing import Callable, Iterable
+
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROW_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+BYTE_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+
+def _fmt_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+             for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labelnames: tuple[str, ...], buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.doc, self.labelnames, self.buckets = name, doc, labelnames, buckets
+        self._series: dict[tuple, list] = {}  # labels -> [cuentas por bucket..., suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float) -> None:
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, s in sorted(self._series.items()):
+                for b, n in zip(self.buckets, s):
+                    le = 'le="%s"' % b
+                    out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, le)} {n}")
+                le = 'le="+Inf"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, le)} {s[-1]}")
+                out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {s[-2]}")
+                out.append(f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {s[-1]}")
+        return out
+
+
+class Gauge:
+    """Value read at scrape time from a callback returning [(label values, value)]."""
+
+    def __init__(self, name: str, doc: str, labelnames: tuple[str, ...],
+                 collect: Callable[[], Iterable[tuple[tuple, float]]], kind: str = "gauge"):
+        self.name, self.doc, self.labelnames, self.collect, self.kind = name, doc, labelnames, collect, kind
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        out += [f"{self.name}{_fmt_labels(self.labelnames, labels)} {value}" for labels, value in self.collect()]
+        return out
+
+
+REGISTRY: list = []
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+def render() -> str:
+    lines: list[str] = []
+    for m in REGISTRY:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = register(Histogram(
+    "emsv_request_duration_seconds", "Tiempo total de la petición", ("route", "method", "status")))
+DUCKDB_SECONDS = register(Histogram(
+    "emsv_duckdb_seconds", "Tiempo de ejecución y lectura en DuckDB por petición", ("route",)))
+SERIALIZATION_SECONDS = register(Histogram(
+    "emsv_serialization_seconds", "Tiempo fuera de DuckDB y del pool (Python, serialización, framework)", ("route",)))
+POOL_WAIT_SECONDS = register(Histogram(
+    "emsv_pool_wait_seconds", "Espera por plaza de la cola y cursor del pool", ("route",)))
+ROWS = register(Histogram(
+    "emsv_rows_returned", "Filas devueltas por DuckDB por petición", ("route",), ROW_BUCKETS))
+RESPONSE_BYTES = register(Histogram(
+    "emsv_response_bytes", "Bytes enviados por petición (tras compresión)", ("route",), BYTE_BUCKETS))
+
+
+class RequestStats:
+    __slots__ = ("route", "duckdb", "pool_wait", "rows")
+
+    def __init__(self, route: str | None = None):
+        self.route = route
+        self.duckdb = 0.0
+        self.pool_wait = 0.0
+        self.rows = 0
+
+
+_current: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar("emsv_request_stats", default=None)
+
+def record_query(seconds: float, rows: int = 0) -> None:
+    st = _current.get()
+    if st is not None:
+        st.duckdb += seconds
+        st.rows += rows
+
+def record_pool_wait(seconds: float) -> None:
+    st = _current.get()
+    if st is not None:
+        st.pool_wait += seconds
+
+def current_route() -> str | None:
+    st = _current.get()
+    return st.route if st is not None else None
+
+
+def route_template(app, scope) -> str:
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", scope["path"])
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """Middleware outside the response cache: one observation per request in every histogram."""
+
+    def __init__(self, app, router_app, skip: tuple[str, ...] = ("/metrics",)):
+        self.app = app
+        self.router_app = router_app  # la app FastAPI, para resolver la plantilla de ruta
+        self.skip = skip
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.skip):
+            return await self.app(scope, receive, send)
+        route = route_template(self.router_app, scope)
+        stats = RequestStats(route)
+        token = _current.set(stats)
+        status, nbytes = 500, 0
+        t0 = time.perf_counter()
+
+        async def wrapped_send(message):
+            nonlocal status, nbytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                nbytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            _current.reset(token)
+            total = time.perf_counter() - t0
+            REQUEST_SECONDS.observe((route, scope["method"], status), total)
+            DUCKDB_SECONDS.observe((route,), stats.duckdb)
+            POOL_WAIT_SECONDS.observe((route,), stats.pool_wait)
+            SERIALIZATION_SECONDS.observe((route,), max(0.0, total - stats.duckdb - stats.pool_wait))
+            ROWS.observe((route,), stats.rows)
+            RESPONSE_BYTES.observe((route,), nbytes)
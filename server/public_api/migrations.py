@@ -0,0 +1,436 @@
+# migrations.py — idempotent schema migrations for warehouse.duckdb
+#
+# Uso:
+#   python migrations.py            # aplica migraciones pendientes + índices,
+#                                   # rehace cels_points y las pirámides desfasadas
+#   python migrations.py --status   # sólo informa, no modifica nada
+#   python migrations.py --check    # comprueba que el planificador usa los R-tree
+#
+# Tras reconstruir el warehouse hay que lanzarlo a mano: app.py solo migra al
+# arrancar con AUTO_MIGRATE=true (por defecto no) y nunca con READ_ONLY=true.
+from __future__ import annotations
+import os, sys, duckdb
+from contextlib import contextmanager
+from typing import Callable
+
+from dotenv import load_dotenv
+
+# ============================================================
+# REGISTRY
+# ============================================================
+
+MIGRATIONS: list[tuple[str, Callable[[duckdb.DuckDBPyConnection], None]]] = []
+
+def migration(name: str):
+    """Registers a migration step; steps run once, in declaration order."""
+    def deco(fn):
+        MIGRATIONS.append((name, fn))
+        return fn
+    return deco
+
+# Tablas con geometría filtrada por bbox (parse_bbox / parse_bbox_for_srid)
+SPATIAL_TABLES = ("buildings", "parcels", "big_points", "point_buffers",
+                  "irr_points", "shadows", "puntos_no_parcelas")
+# SRID de la geometría cuando no es EPSG:4326 (el bbox se transforma a él)
+NATIVE_SRIDS = {"irr_points": 25830}
+# bbox de ejemplo (Getafe, WGS84) para las consultas de comprobación
+PROBE_BBOX = (-3.75, 40.29, -3.70, 40.32)
+
+# Tablas grandes que se reordenan por clave de Hilbert y llevan columnas bbox
+HILBERT_TABLES = ("buildings", "parcels", "irr_points", "shadows", "puntos_no_parcelas")
+BBOX_COLUMNS = ("minx", "miny", "maxx", "maxy")
+
+# Pirámide para estadística zonal: tabla -> (columna de valor, celda más fina
+# en unidades del SRID nativo). Nivel k tiene celdas de base·ZONAL_RATIO^k.
+ZONAL_GRIDS: dict[str, tuple[str, float]] = {
+    "irr_points": ("value", 5.0),                   # EPSG:25830, metros
+    "shadows": ("shadow_count", 0.00005),           # EPSG:4326, grados (~5 m)
+    "puntos_no_parcelas": ("shadow_count", 0.00005),
+}
+ZONAL_LEVELS = 5
+ZONAL_RATIO = 4
+
+def grid_cell_expr(coord: str, base: float) -> str:
+    """Índice de celda fina de una coordenada (misma expresión al construir y al consultar)."""
+    return f"CAST(floor({coord} / CAST({base!r} AS DOUBLE)) AS BIGINT)"
+
+# Niveles de detalle: geom_lod1..N = ST_SimplifyPreserveTopology(geom, tolerancia)
+# con tolerancia en grados (EPSG:4326): ~1 m, ~5 m, ~20 m
+LOD_TABLES = ("buildings", "parcels")
+LOD_TOLERANCES = (0.00001, 0.00005, 0.0002)
+
+def lod_column(level: int) -> str:
+    return f"geom_lod{level}"
+
+def rtree_index_name(table: str) -> str:
+    return f"idx_{table.lower()}_geom_rtree"
+
+# (tabla, nombre del índice, definición tras "ON tabla")
+INDEXES: list[tuple[str, str, str]] = [
+    ("buildings", "idx_buildings_ref_upper", "(ref_upper)"),
+    ("buildings", "idx_buildings_ref14", "(ref14)"),
+    ("edificios_metrics", "idx_edificios_metrics_ref_upper", "(ref_upper)"),
+    ("autoconsumos_CELS", "idx_autoconsumos_cels_ref_upper", "(ref_upper)"),
+    ("autoconsumos_CELS", "idx_autoconsumos_cels_ref14", "(ref14)"),
+    ("cels_points", "idx_cels_points_id", "(id)"),
+] + [(t, rtree_index_name(t), "USING RTREE (geom)") for t in SPATIAL_TABLES]
+
+# ============================================================
+# HELPERS
+# ============================================================
+
+def table_exists(con: duckdb.DuckDBPyConnection, table: str) -> bool:
+    return bool(con.execute(
+        "SELECT 1 FROM duckdb_tables() WHERE lower(table_name) = lower(?) LIMIT 1;", [table]
+    ).fetchall())
+
+def column_exists(con: duckdb.DuckDBPyConnection, table: str, column: str) -> bool:
+    return bool(con.execute(
+        "SELECT 1 FROM duckdb_columns() "
+        "WHERE lower(table_name) = lower(?) AND lower(column_name) = lower(?) LIMIT 1;",
+        [table, column],
+    ).fetchall())
+
+def existing_indexes(con: duckdb.DuckDBPyConnection, table: str | None = None) -> set[str]:
+    sql = "SELECT index_name FROM duckdb_indexes()"
+    params: list = []
+    if table:
+        sql += " WHERE lower(table_name) = lower(?)"
+        params = [table]
+    return {r[0] for r in con.execute(sql, params).fetchall()}
+
+@contextmanager
+def without_indexes(con: duckdb.DuckDBPyConnection, table: str):
+    """
+    DuckDB no permite ALTER de una tabla con índices: se quitan durante el bloque.
+    Los índices ajenos a INDEXES se recrean con su SQL original al salir; los
+    declarados los repone ensure_indexes().
+    """
+    declared = {name for _, name, _ in INDEXES}
+    rows = con.execute(
+        "SELECT index_name, sql FROM duckdb_indexes() WHERE lower(table_name) = lower(?);", [table]
+    ).fetchall()
+    for name, _ in rows:
+        con.execute(f'DROP INDEX IF EXISTS "{name}";')
+    yield
+    for name, sql in rows:
+        if name not in declared and sql:
+            con.execute(sql)
+
+def ensure_indexes(con: duckdb.DuckDBPyConnection) -> list[str]:
+    """Creates every declared index that is missing. Returns the names created."""
+    created = []
+    for table, name, definition in INDEXES:
+        if not table_exists(con, table) or name in existing_indexes(con, table):
+            continue
+        try:
+            con.execute(f'CREATE INDEX "{name}" ON {table} {definition};')
+            created.append(name)
+        except duckdb.Error as e:
+            print(f"[migrations] no se pudo crear {name}: {e}")
+    return created
+
+def bbox_probe_queries(table: str) -> list[tuple[str, list]]:
+    """
+    The bbox queries of app.py that should use the R-tree of `table`, with
+    parameters: the bare parse_bbox()/parse_bbox_for_srid() filter and the
+    R-tree keyset page of paginate(). For the CLI, which cannot import app.py;
+    app.py passes its own builders.
+    """
+    env = "ST_MakeEnvelope(?, ?, ?, ?)"
+    if table in NATIVE_SRIDS:
+        env = f"ST_Transform({env}, 'EPSG:4326', 'EPSG:{NATIVE_SRIDS[table]}', TRUE)"
+    where, params = f"WHERE ST_Intersects(geom, {env})", list(PROBE_BBOX)
+    return [
+        (f"SELECT geom FROM {table} {where}", params),
+        (f"SELECT * FROM (SELECT rowid AS _k, geom FROM {table} {where} OFFSET 0) "
+         f"WHERE _k > ? ORDER BY _k LIMIT ?", params + [0, 100]),
+    ]
+
+def spatial_index_report(con: duckdb.DuckDBPyConnection,
+                         probes: Callable[[str], list[tuple[str, list]]] = bbox_probe_queries) -> list[dict]:
+    """
+    Per spatial table: whether its R-tree exists and whether the planner picks
+    it for every query probes(table) returns (the API's real bbox queries).
+    """
+    report = []
+    for table in SPATIAL_TABLES:
+        if not table_exists(con, table):
+            continue
+        name = rtree_index_name(table)
+        present = name in existing_indexes(con, table)
+        used = False
+        if present:
+            used = all(
+                any("rtree_index_scan" in str(r[-1]).lower()
+                    for r in con.execute(f"EXPLAIN {sql}", params).fetchall())
+                for sql, params in probes(table)
+            )
+        report.append({"table": table, "index": name, "present": present, "used": used})
+    return report
+
+def applied(con: duckdb.DuckDBPyConnection) -> set[str]:
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+          name VARCHAR PRIMARY KEY,
+          applied_at TIMESTAMP DEFAULT current_timestamp
+        );
+    """)
+    return {r[0] for r in con.execute("SELECT name FROM schema_migrations;").fetchall()}
+
+def apply_migrations(con: duckdb.DuckDBPyConnection) -> list[str]:
+    """Runs pending migrations (one transaction each) and then ensure_indexes()."""
+    done = applied(con)
+    ran = []
+    for name, fn in MIGRATIONS:
+        if name in done:
+            continue
+        con.execute("BEGIN")
+        try:
+            fn(con)
+            con.execute("INSERT INTO schema_migrations (name) VALUES (?);", [name])
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        print(f"[migrations] aplicada {name}")
+        ran.append(name)
+    ensure_indexes(con)
+    return ran
+
+# ============================================================
+# MIGRATIONS
+# ============================================================
+
+REF_TABLES = ("buildings", "edificios_metrics", "autoconsumos_CELS")
+
+@migration("001_reference_columns")
+def _reference_columns(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    ref_upper = UPPER(reference) y ref14 = LEFT(UPPER(reference), 14) precalculadas,
+    para que las búsquedas por referencia sean lecturas puntuales del índice ART
+    y los cruces CELS↔edificio no calculen UPPER/LEFT fila a fila.
+    """
+    for table in REF_TABLES:
+        if not table_exists(con, table):
+            continue
+        with without_indexes(con, table):
+            for col in ("ref_upper", "ref14"):
+                if not column_exists(con, table, col):
+                    con.execute(f"ALTER TABLE {table} ADD COLUMN {col} VARCHAR;")
+            con.execute(f"""
+                UPDATE {table}
+                SET ref_upper = UPPER(reference),
+                    ref14 = LEFT(UPPER(reference), 14);
+            """)
+
+@migration("002_cels_points")
+def _cels_points(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    Ubicación materializada de cada CELS: un punto sobre su edificio (primer
+    edificio por referencia con el mismo ref14) en EPSG:4326 y EPSG:25830.
+    La mantienen create_cels / update_cels / delete_cel en su transacción.
+    """
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS cels_points (
+          id INTEGER,
+          geom GEOMETRY,
+          geom_25830 GEOMETRY
+        );
+    """)
+    if table_exists(con, "autoconsumos_CELS") and table_exists(con, "buildings"):
+        refresh_cels_points(con)
+
+def cels_points_select(ref14_c: str = "c.ref14", ref14_b: str = "b.ref14", where: str = "") -> str:
+    """SELECT id, geom, geom_25830 de cels_points: un punto sobre el edificio de cada CELS."""
+    return f"""
+        SELECT id, pt, ST_Transform(pt, 'EPSG:4326', 'EPSG:25830', TRUE)
+        FROM (
+          SELECT c.id, ST_PointOnSurface(b.geom) AS pt
+          FROM autoconsumos_CELS c
+          JOIN buildings b ON {ref14_b} = {ref14_c}
+          {where}
+          QUALIFY ROW_NUMBER() OVER (PARTITION BY c.id ORDER BY b.reference) = 1
+        )
+    """
+
+def refresh_cels_points(con: duckdb.DuckDBPyConnection, cid: int | None = None,
+                        table: str = "cels_points", ref14_c: str = "c.ref14",
+                        ref14_b: str = "b.ref14") -> None:
+    """
+    Recalcula cels_points (o `table`) para un CELS (cid) o para todos. No abre
+    transacción. ref14_c / ref14_b: expresiones de ref14 si faltan las columnas.
+    """
+    where = "" if cid is None else "WHERE c.id = ?"
+    params = [] if cid is None else [cid]
+    con.execute(f"DELETE FROM {table} {'' if cid is None else 'WHERE id = ?'};", params)
+    con.execute(f"INSERT INTO {table} (id, geom, geom_25830) {cels_points_select(ref14_c, ref14_b, where)};",
+                params)
+
+@migration("003_hilbert_layout")
+def _hilbert_layout(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    Reescribe las tablas en orden de Hilbert (sobre la extensión de la tabla) y
+    añade minx/miny/maxx/maxy de cada geometría. Los row groups quedan
+    espacialmente compactos, así que un filtro numérico sobre el bbox se
+    resuelve con zone maps sin leer los row groups fuera del viewport.
+    La tabla se recrea (CREATE OR REPLACE): se conservan columnas y datos,
+    no las restricciones.
+    """
+    exclude = ", ".join(f"'{c}'" for c in BBOX_COLUMNS)
+    for table in HILBERT_TABLES:
+        if not table_exists(con, table):
+            continue
+        with without_indexes(con, table):
+            con.execute(f"""
+                CREATE OR REPLACE TABLE {table} AS
+                SELECT s.*,
+                       ST_XMin(s.geom) AS minx, ST_YMin(s.geom) AS miny,
+                       ST_XMax(s.geom) AS maxx, ST_YMax(s.geom) AS maxy
+                FROM (SELECT COLUMNS(c -> c NOT IN ({exclude})) FROM {table}) s
+                ORDER BY ST_Hilbert(
+                  s.geom,
+                  (SELECT ST_Extent(ST_Extent_Agg(geom)) FROM {table})
+                );
+            """)
+
+@migration("004_zonal_grid")
+def _zonal_grid(con: duckdb.DuckDBPyConnection) -> None:
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS zonal_grid (
+          tbl VARCHAR, level INTEGER, ix BIGINT, iy BIGINT,
+          n BIGINT, nv BIGINT, s DOUBLE, mn DOUBLE, mx DOUBLE
+        );
+    """)
+    for table in ZONAL_GRIDS:
+        if table_exists(con, table):
+            build_zonal_grid(con, table)
+
+def zonal_source_signature(con: duckdb.DuckDBPyConnection, table: str) -> tuple[int, int]:
+    """Filas + XOR de hash(geom, valor): cambia si se recargan o recalculan los puntos."""
+    value, _ = ZONAL_GRIDS[table]
+    n, sig = con.execute(f"SELECT COUNT(*), bit_xor(hash(geom, {value})) FROM {table};").fetchone()
+    return int(n), int(sig or 0)
+
+def build_zonal_grid(con: duckdb.DuckDBPyConnection, table: str) -> None:
+    """
+    (Re)construye la pirámide de una tabla de puntos: por celda y nivel,
+    n = filas, nv = valores no nulos, s/mn/mx = suma, mínimo y máximo.
+    Cada nivel se agrega desde el anterior por división entera del índice,
+    así cada celda está contenida exactamente en su celda padre.
+    La firma de los puntos usados queda en zonal_grid_source.
+    """
+    value, base = ZONAL_GRIDS[table]
+    n, sig = zonal_source_signature(con, table)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS zonal_grid_source (tbl VARCHAR PRIMARY KEY, n BIGINT, sig UBIGINT);
+    """)
+    con.execute("INSERT OR REPLACE INTO zonal_grid_source VALUES (?, ?, ?);", [table, n, sig])
+    con.execute("DELETE FROM zonal_grid WHERE tbl = ?;", [table])
+    con.execute(f"""
+        INSERT INTO zonal_grid
+        SELECT ?, 0,
+               {grid_cell_expr("ST_X(geom)", base)} AS ix,
+               {grid_cell_expr("ST_Y(geom)", base)} AS iy,
+               COUNT(*), COUNT(v), SUM(v), MIN(v), MAX(v)
+        FROM (SELECT geom, CAST({value} AS DOUBLE) AS v FROM {table})
+        GROUP BY ALL
+        ORDER BY ix, iy;
+    """, [table])
+    for k in range(1, ZONAL_LEVELS):
+        con.execute(f"""
+            INSERT INTO zonal_grid
+            SELECT tbl, {k},
+                   CAST(floor(ix / {ZONAL_RATIO}) AS BIGINT) AS pix,
+                   CAST(floor(iy / {ZONAL_RATIO}) AS BIGINT) AS piy,
+                   SUM(n), SUM(nv), SUM(s), MIN(mn), MAX(mx)
+            FROM zonal_grid
+            WHERE tbl = ? AND level = {k - 1}
+            GROUP BY ALL
+            ORDER BY pix, piy;
+        """, [table])
+
+def refresh_zonal_grids(con: duckdb.DuckDBPyConnection, rebuild: bool = True) -> set[str]:
+    """
+    Tablas cuya pirámide está al día: la firma guardada al construirla
+    (filas + XOR de hashes de geom y valor) coincide con la de la tabla, así
+    que una recarga con el mismo nº de filas también se detecta. Cuesta un
+    escaneo de cada tabla de puntos al arrancar.
+    Con rebuild=True reconstruye las desfasadas (p. ej. tras recargar la tabla).
+    """
+    if not table_exists(con, "zonal_grid"):
+        return set()
+    fresh = set()
+    for table in ZONAL_GRIDS:
+        if not table_exists(con, table):
+            continue
+        stored = None
+        if table_exists(con, "zonal_grid_source"):
+            stored = con.execute("SELECT n, sig FROM zonal_grid_source WHERE tbl = ?;", [table]).fetchone()
+        current = zonal_source_signature(con, table)
+        ok = stored is not None and (int(stored[0]), int(stored[1])) == current
+        if not ok and rebuild:
+            con.execute("BEGIN;")
+            try:
+                build_zonal_grid(con, table)
+                con.execute("COMMIT;")
+            except Exception:
+                con.execute("ROLLBACK;")
+                raise
+            ok = True
+        if ok:
+            fresh.add(table)
+    return fresh
+
+@migration("005_geometry_lod")
+def _geometry_lod(con: duckdb.DuckDBPyConnection) -> None:
+    """
+    Geometrías simplificadas precalculadas, una columna por nivel de LOD,
+    para servir edificios y parcelas a zoom bajo sin vértices invisibles.
+    """
+    for table in LOD_TABLES:
+        if not table_exists(con, table):
+            continue
+        with without_indexes(con, table):
+            for level, tol in enumerate(LOD_TOLERANCES, 1):
+                col = lod_column(level)
+                if not column_exists(con, table, col):
+                    con.execute(f"ALTER TABLE {table} ADD COLUMN {col} GEOMETRY;")
+                con.execute(f"UPDATE {table} SET {col} = ST_SimplifyPreserveTopology(geom, {tol!r});")
+
+# ============================================================
+# CLI
+# ============================================================
+
+def _resolve_db_path() -> str:
+    load_dotenv()
+    raw = os.getenv("DUCKDB_PATH", "warehouse.duckdb")
+    if not os.path.isabs(raw):
+        raw = os.path.abspath(os.path.join(os.path.dirname(__file__), raw))
+    return raw
+
+def main(argv: list[str]) -> int:
+    con = duckdb.connect(_resolve_db_path())
+    con.execute("LOAD spatial;")
+    if "--status" in argv:
+        done = applied(con)
+        for name, _ in MIGRATIONS:
+            print(f"{'x' if name in done else ' '} {name}")
+        missing = [n for t, n, _ in INDEXES if table_exists(con, t) and n not in existing_indexes(con, t)]
+        print("índices pendientes:", ", ".join(missing) or "ninguno")
+        return 0
+    if "--check" in argv:
+        report = spatial_index_report(con)
+        for r in report:
+            state = "ok" if r["used"] else ("sin usar" if r["present"] else "FALTA")
+            print(f"{r['table']:<20} {r['index']:<36} {state}")
+        return 0 if all(r["used"] for r in report) else 1
+    ran = apply_migrations(con)
+    print(f"{len(ran)} migraciones aplicadas")
+    # por si buildings o los puntos se han recargado sin tocar schema_migrations
+    refresh_cels_points(con)
+    print("pirámides al día:", ", ".join(sorted(refresh_zonal_grids(con))) or "ninguna")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,127 @@
+# profiler.py — slow-query log with DuckDB EXPLAIN ANALYZE plans
+#
+# q() avisa de cada consulta que supera el umbral; la consulta se repite con
+# EXPLAIN (ANALYZE, FORMAT JSON) en un hilo aparte (no retrasa la respuesta)
+# y el plan con los tiempos por operador queda en un buffer circular que
+# consulta /admin/slow_queries. Cada plantilla SQL se perfila como mucho una
+# vez por `cooldown_s`, para no duplicar la carga de una consulta lenta y frecuente.
+# Solo se repiten lecturas (SELECT / WITH): un INSERT o un COPY ... TO se
+# ejecutarían otra vez. Del resto queda la entrada, sin plan.
+from __future__ import annotations
+import itertools, json, queue, re, threading, time
+from collections import deque
+from typing import Callable
+
+import duckdb
+
+_WS = re.compile(r"\s+")
+_READ_SQL = re.compile(r"(SELECT|WITH)\b", re.IGNORECASE)
+
+
+def sql_template(sql: str) -> str:
+    return _WS.sub(" ", sql).strip()
+
+
+def _short(v, limit: int = 500):
+    r = v if isinstance(v, (int, float, bool)) or v is None else repr(v)
+    return r if not isinstance(r, str) or len(r) <= limit else r[:limit] + f"… ({len(r)} chars)"
+
+
+def flatten_plan(node: dict, depth: int = 0, out: list | None = None) -> list[dict]:
+    """Operators of a JSON profile, depth-first, with their timing and cardinality."""
+    out = [] if out is None else out
+    if "operator_type" in node and node.get("operator_type") != "EXPLAIN_ANALYZE":
+        out.append({
+            "depth": depth,
+            "operator": (node.get("operator_name") or node["operator_type"]).strip(),
+            "timing_ms": round(node.get("operator_timing", 0.0) * 1000, 3),
+            "rows": node.get("operator_cardinality"),
+            "rows_scanned": node.get("operator_rows_scanned"),
+            "extra": node.get("extra_info") or {},
+        })
+        depth += 1
+    for child in node.get("children", []):
+        flatten_plan(child, depth, out)
+    return out
+
+
+def render_plan(ops: list[dict]) -> str:
+    lines = []
+    for op in ops:
+        extra = ", ".join(f"{k}: {v}" for k, v in op["extra"].items() if v not in ("", None))
+        lines.append(f"{'  ' * op['depth']}{op['operator']}"
+                     f"{f' ({extra})' if extra else ''}"
+                     f"  rows={op['rows']} time={op['timing_ms']}ms")
+    return "\n".join(lines)
+
+
+class SlowQueryProfiler:
+    def __init__(self, cursor_factory: Callable[[], duckdb.DuckDBPyConnection],
+                 threshold_ms: float, ring_size: int = 200, cooldown_s: float = 300,
+                 max_pending: int = 16):
+        self.cursor_factory = cursor_factory
+        self.threshold_ms = threshold_ms
+        self.cooldown_s = cooldown_s
+        self._ring: deque[dict] = deque(maxlen=ring_size)
+        self._pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._last: dict[str, float] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._worker: threading.Thread | None = None
+
+    def observe(self, sql: str, params, elapsed_s: float, rows: int | None = None,
+                route: str | None = None) -> None:
+        """Called after every query; cheap unless the query was slow."""
+        if self.threshold_ms <= 0 or elapsed_s * 1000 < self.threshold_ms:
+            return
+        template = sql_template(sql)
+        now = time.time()
+        with self._lock:
+            if now - self._last.get(template, 0) < self.cooldown_s:
+                return
+            self._last[template] = now
+            entry = {
+                "id": next(self._ids),
+                "at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now)),
+                "route": route,
+                "elapsed_ms": round(elapsed_s * 1000, 1),
+                "rows": rows,
+                "sql": template,
+                "params": [_short(p) for p in (params or [])],
+                "plan": None,
+                "operators": None,
+            }
+            self._ring.append(entry)
+            if not _READ_SQL.match(template):
+                entry["plan_error"] = "solo se perfilan lecturas (SELECT / WITH)"
+                return
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="slow-query-profiler", daemon=True)
+                self._worker.start()
+        try:
+            self._pending.put_nowait((entry, sql, list(params or [])))
+        except queue.Full:
+            entry["plan_error"] = "cola del profiler llena"
+
+    def _run(self) -> None:
+        cur = None
+        while True:
+            entry, sql, params = self._pending.get()
+            try:
+                if cur is None:
+                    cur = self.cursor_factory()
+                row = cur.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}", params).fetchone()
+                ops = flatten_plan(json.loads(row[1]))
+                entry["operators"] = ops
+                entry["plan"] = render_plan(ops)
+            except Exception as e:  # el profiler nunca debe tumbar nada
+                entry["plan_error"] = str(e)
+
+    def entries(self, limit: int = 50) -> list[dict]:
+        with self._lock:
+            return list(reversed(self._ring))[:limit]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ring.clear()
+            self._last.clear()
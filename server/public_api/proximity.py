@@ -0,0 +1,121 @@
+# proximity.py — in-memory KD-tree over CELS points in EPSG:25830 (metres)
+#
+# El índice se reconstruye entero (unos cientos de puntos) al arrancar y tras
+# cada escritura de CELS; las consultas de radio / k-vecinos no tocan DuckDB.
+from __future__ import annotations
+import heapq, math, duckdb
+from typing import Callable, Iterable, NamedTuple
+
+
+class CelsPoint(NamedTuple):
+    id: int
+    auto_CEL: int | None
+    x: float
+    y: float
+
+
+class KDTree:
+    """Static 2-D KD-tree; it is rebuilt, never mutated, when the data changes."""
+
+    def __init__(self, points: Iterable[tuple[float, float, object]]):
+        self.size = 0
+        self._root = self._build(list(points), 0)
+
+    def _build(self, pts: list, depth: int):
+        if not pts:
+            return None
+        axis = depth & 1
+        pts.sort(key=lambda p: p[axis])
+        mid = len(pts) // 2
+        self.size += 1
+        # nodo = (punto, eje, izquierda, derecha)
+        return (pts[mid], axis,
+                self._build(pts[:mid], depth + 1),
+                self._build(pts[mid + 1:], depth + 1))
+
+    def within(self, x: float, y: float, r: float,
+               pred: Callable[[object], bool] | None = None) -> list[tuple[float, object]]:
+        """All items at distance <= r, as (distance, item) sorted by distance."""
+        out = []
+        r2 = r * r
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            (px, py, item), axis, left, right = node
+            dx, dy = px - x, py - y
+            d2 = dx * dx + dy * dy
+            if d2 <= r2 and (pred is None or pred(item)):
+                out.append((math.sqrt(d2), item))
+            q, split = (x, px) if axis == 0 else (y, py)
+            if q - r <= split:
+                stack.append(left)
+            if q + r >= split:
+                stack.append(right)
+        out.sort(key=lambda t: t[0])
+        return out
+
+    def nearest(self, x: float, y: float, k: int = 1, max_dist: float = math.inf,
+                pred: Callable[[object], bool] | None = None) -> list[tuple[float, object]]:
+        """The k closest items within max_dist, as (distance, item) sorted by distance."""
+        best: list[tuple[float, int, object]] = []  # max-heap por -d2
+        limit2 = max_dist * max_dist
+        seq = 0
+
+        def visit(node):
+            nonlocal seq
+            if node is None:
+                return
+            (px, py, item), axis, left, right = node
+            dx, dy = px - x, py - y
+            d2 = dx * dx + dy * dy
+            if d2 <= limit2 and (pred is None or pred(item)):
+                seq += 1
+                if len(best) < k:
+                    heapq.heappush(best, (-d2, seq, item))
+                elif d2 < -best[0][0]:
+                    heapq.heapreplace(best, (-d2, seq, item))
+            diff = (x - px) if axis == 0 else (y - py)
+            near, far = (left, right) if diff <= 0 else (right, left)
+            visit(near)
+            bound = limit2 if len(best) < k else min(limit2, -best[0][0])
+            if diff * diff <= bound:
+                visit(far)
+
+        visit(self._root)
+        return sorted(((math.sqrt(-d2), item) for d2, _, item in best), key=lambda t: t[0])
+
+
+class CelsIndex:
+    """Radius / k-nearest search over cels_points.geom_25830."""
+
+    def __init__(self):
+        self._tree = KDTree([])
+
+    @property
+    def size(self) -> int:
+        return self._tree.size
+
+    def refresh(self, con: duckdb.DuckDBPyConnection, table: str = "cels_points") -> None:
+        rows = con.execute(f"""
+            SELECT p.id, c.auto_CEL, ST_X(p.geom_25830), ST_Y(p.geom_25830)
+            FROM {table} p
+            JOIN autoconsumos_CELS c ON c.id = p.id;
+        """).fetchall()
+        pts = [CelsPoint(int(i), int(a) if a is not None else None, float(x), float(y))
+               for i, a, x, y in rows if x is not None and y is not None]
+        # sustitución atómica: las lecturas en curso siguen con el árbol anterior
+        self._tree = KDTree((p.x, p.y, p) for p in pts)
+
+    @staticmethod
+    def _pred(auto_cel: int | None):
+        return None if auto_cel is None else (lambda p: p.auto_CEL == auto_cel)
+
+    def within(self, x: float, y: float, radius_m: float,
+               auto_cel: int | None = None) -> list[tuple[float, CelsPoint]]:
+        return self._tree.within(x, y, radius_m, self._pred(auto_cel))
+
+    def nearest(self, x: float, y: float, k: int = 1, max_dist: float = math.inf,
+                auto_cel: int | None = None) -> list[tuple[float, CelsPoint]]:
+        return self._tree.nearest(x, y, k, max_dist, self._pred(auto_cel))